@@ -0,0 +1,251 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import asyncio
+import threading
+import time
+import json
+import re
+
+from metrics import get_metrics
+
+
+# Open-Meteo free tier limits: (api calls, period in seconds), keys match the first word of the 429 reason
+OPEN_METEO_LIMITS = {'Minutely': (600, 60), 'Hourly': (5000, 3600), 'Daily': (10000, 86400)}
+
+
+def request_weight(n_locations: int, n_variables: int, n_days: int) -> float:
+    """
+    Number of api calls Open-Meteo counts for one request
+    More than 10 variables or more than 2 weeks of data count as several calls, each location counts separately
+    """
+
+    return n_locations * max(1, n_variables / 10) * max(1, n_days / 14)
+
+
+def max_locations(n_variables: int, n_days: int, limit: float = OPEN_METEO_LIMITS['Minutely'][0]) -> int:
+    """
+    Largest number of locations of one request that fits into limit api calls, at least 1
+    """
+
+    return max(1, int(limit // request_weight(1, n_variables, n_days)))
+
+
+def limit_reason(e: Exception) -> str:
+    """
+    Return Minutely, Hourly or Daily for rate limit errors and empty string otherwise
+    """
+
+    reason = e.args[0]['reason'] if e.args and isinstance(e.args[0], dict) else str(e)
+    match = re.search(r'(Minutely|Hourly|Daily) API request limit', reason)
+    return match.group(1) if match else ''
+
+
+class TokenBucket:
+    """
+    Bucket never lets more than limit tokens out in any window of period seconds:
+    burst tokens are available at once and the rest refills at (limit - burst) / period per second
+    Capacity grows to the largest request weight and the refill rate slows down by the same amount,
+    so a heavy request waits for all of its tokens instead of driving the bucket into debt
+    """
+
+    def __init__(self, limit: float, period: float, burst: float = 0.1):
+        self.limit = limit
+        self.period = period
+        self.capacity = max(limit * burst, 1)
+        self.rate = (limit - self.capacity) / period
+        self.tokens = self.capacity
+        self.updated = time.time()
+
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+    def fit(self, n: float):
+        if self.capacity < n < self.limit:
+            self.capacity = n
+            self.rate = (self.limit - self.capacity) / self.period
+
+
+    def wait_time(self, n: float, now: float) -> float:
+        self.refill(now)
+        self.fit(n)
+        return max(0, (min(n, self.capacity) - self.tokens) / self.rate) if self.rate > 0 else 0
+
+
+    def take(self, n: float):
+        self.tokens -= n
+
+
+class RateLimiter:
+    """
+    Thread-safe limiter spacing calls of all threads at least 1 / requests_per_second seconds apart
+    """
+
+    def __init__(self, requests_per_second: float):
+        self.interval = 1 / requests_per_second
+        self.next_time = time.time()
+        self.lock = threading.Lock()
+
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            self.next_time = max(self.next_time, now)
+            timeout = self.next_time - now
+            self.next_time += self.interval
+
+        if timeout > 0:
+            get_metrics().inc('quota_wait_seconds_total', timeout, limit='rate')
+            time.sleep(timeout)
+
+
+class QuotaScheduler:
+    """
+    Paces requests with one token bucket per api limit and keeps bucket state in a json file,
+    so a restarted process continues with the quota already spent
+    """
+
+    def __init__(self, limits: dict = OPEN_METEO_LIMITS, state_file: str | None = '.quota.json', burst: float = 0.1, save_interval: float = 1):
+        self.buckets = {name: TokenBucket(limit, period, burst) for name, (limit, period) in limits.items()}
+        self.state_file = state_file
+        self.save_interval = save_interval
+        self.saved = 0
+        self.lock = None
+        self.load()
+
+
+    def load(self):
+        if not self.state_file:
+            return
+
+        try:
+            with open(self.state_file) as file:
+                state = json.load(file)
+        except Exception:
+            return
+
+        for name, bucket in self.buckets.items():
+            if name in state:
+                bucket.tokens = min(bucket.capacity, state[name]['tokens'])
+                bucket.updated = state[name]['updated']
+
+
+    def save(self, force: bool = False):
+        if not self.state_file or (not force and time.time() - self.saved < self.save_interval):
+            return
+
+        with open(self.state_file, 'w') as file:
+            json.dump({name: {'tokens': bucket.tokens, 'updated': bucket.updated} for name, bucket in self.buckets.items()}, file)
+        self.saved = time.time()
+
+
+    async def acquire(self, weight: float = 1):
+        """
+        Wait until every bucket has weight tokens and take them
+        """
+
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+
+        async with self.lock:
+            while True:
+                now = time.time()
+                timeout = max(bucket.wait_time(weight, now) for bucket in self.buckets.values())
+                if timeout <= 0:
+                    break
+                get_metrics().inc('quota_wait_seconds_total', timeout, limit='scheduler')
+                await asyncio.sleep(timeout)
+
+            for bucket in self.buckets.values():
+                bucket.take(weight)
+            self.save()
+
+
+    def max_weight(self) -> float:
+        """
+        Largest request weight paced at no less than half of every limit: heavier requests grow the buckets
+        and slow their refill down, see TokenBucket
+        """
+
+        return min(bucket.limit / 2 for bucket in self.buckets.values())
+
+
+    def exhaust(self, name: str):
+        """
+        Empty the bucket after the api reported its limit, tokens come back at the bucket rate
+        """
+
+        self.buckets[name].refill(time.time())
+        self.buckets[name].tokens = min(self.buckets[name].tokens, 0)
+        self.save(force=True)
+
+
+class AsyncFetcher:
+    """
+    Runs blocking fetch functions in a thread pool keeping up to concurrency of them in flight,
+    every call takes its weight from the quota scheduler first
+    """
+
+    def __init__(self, scheduler: QuotaScheduler, concurrency: int = 8, attempts: int = 3):
+        self.scheduler = scheduler
+        self.concurrency = concurrency
+        self.attempts = attempts
+
+
+    async def worker(self, queue: asyncio.Queue, results: list, executor: ThreadPoolExecutor):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            k, weight, fetch, attempt = await queue.get()
+
+            try:
+                await self.scheduler.acquire(weight)
+                results[k] = await loop.run_in_executor(executor, fetch)
+            except Exception as e:
+                reason = limit_reason(e)
+
+                get_metrics().inc('retries_total', dataset='async')
+
+                if reason in self.scheduler.buckets:
+                    self.scheduler.exhaust(reason)
+                    print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: Exceeded {reason}, task {k+1} is postponed')
+                else:
+                    print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: Attempt: {attempt}/{self.attempts} task {k+1} failed\n{e}')
+
+                if attempt < self.attempts:
+                    queue.put_nowait((k, weight, fetch, attempt + 1))
+            finally:
+                queue.task_done()
+
+
+    async def run(self, tasks: list[tuple]) -> list:
+        """
+        Run (weight, fetch) tasks and return their results in the same order, None for failed tasks
+        """
+
+        results = [None] * len(tasks)
+        self.scheduler.lock = asyncio.Lock()
+        queue = asyncio.Queue()
+        for k, (weight, fetch) in enumerate(tasks):
+            queue.put_nowait((k, weight, fetch, 1))
+
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            workers = [asyncio.create_task(self.worker(queue, results, executor)) for _ in range(self.concurrency)]
+            await queue.join()
+
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        self.scheduler.save(force=True)
+        return results
+
+
+    def fetch(self, tasks: list[tuple]) -> list:
+        return asyncio.run(self.run(tasks))
+
+
+def days_between(startdate: str, enddate: str) -> int:
+    return (datetime.strptime(enddate, '%Y-%m-%d') - datetime.strptime(startdate, '%Y-%m-%d')).days + 1
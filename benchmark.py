@@ -0,0 +1,696 @@
+import openmeteo_requests
+
+import requests_cache
+import pandas as pd
+from retry_requests import retry
+import flatbuffers
+import numpy as np
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from datetime import datetime, timezone
+from collections import deque
+from contextlib import redirect_stdout
+import resource
+import tempfile
+import threading
+import time
+import json
+import os.path
+
+from http_session import HttpSession
+from async_fetch import AsyncFetcher, QuotaScheduler, request_weight
+from merge_csv import MergeCsv
+from join_datasets import JoinDatasets
+from dataset_schema import DatasetSchema, WEATHER_SCHEMA, AIR_QUALITY_SCHEMA
+from open_meteo_weather_parser import WeatherParser
+from open_meteo_air_quality_parser import AirQualityParser
+from open_weather_parser import OpenWeatherParser
+from cfo_cities import DadataParser
+from grid_index import GridIndex
+from openmeteo_sdk.WeatherApiResponse import WeatherApiResponse
+
+
+def location_seed(lat: float, lon: float) -> list[int]:
+    """
+    Seed of mock values of a location, so the same location always gets the same series
+    """
+
+    return [round((lat + 90) * 10000), round((lon + 180) * 10000)]
+
+
+def encode_response(lat: float, lon: float, start: int, end: int, n_variables: int, interval: int = 3600, location_id: int = 0, utc_offset: int = 10800,
+                    seed: list[int] | None = None) -> bytes:
+    """
+    Build size-prefixed Open-Meteo FlatBuffers message with random hourly values, values are reproducible for the same seed
+    Field slots follow openmeteo_sdk WeatherApiResponse, VariablesWithTime and VariableWithValues tables
+    """
+
+    builder = flatbuffers.Builder(1024)
+    n = (end - start) // interval
+    rng = np.random.default_rng(seed)
+
+    variables = []
+    for k in range(n_variables):
+        values = builder.CreateNumpyVector(rng.random(n, dtype=np.float32))
+        builder.StartObject(4)
+        builder.PrependUint8Slot(0, k + 1, 0)
+        builder.PrependUOffsetTRelativeSlot(3, values, 0)
+        variables.append(builder.EndObject())
+
+    builder.StartVector(4, len(variables), 4)
+    for variable in reversed(variables):
+        builder.PrependUOffsetTRelative(variable)
+    variables_vector = builder.EndVector()
+
+    builder.StartObject(4)
+    builder.PrependInt64Slot(0, start, 0)
+    builder.PrependInt64Slot(1, end, 0)
+    builder.PrependInt32Slot(2, interval, 0)
+    builder.PrependUOffsetTRelativeSlot(3, variables_vector, 0)
+    hourly = builder.EndObject()
+
+    builder.StartObject(16)
+    builder.PrependFloat32Slot(0, lat, 0)
+    builder.PrependFloat32Slot(1, lon, 0)
+    builder.PrependInt32Slot(4, location_id, 0)
+    builder.PrependInt32Slot(6, utc_offset, 0)
+    builder.PrependUOffsetTRelativeSlot(11, hourly, 0)
+    builder.Finish(builder.EndObject())
+
+    data = bytes(builder.Output())
+    return len(data).to_bytes(4, byteorder='little') + data
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    # Keep-alive connections with Nagle enabled stall on delayed ack, real servers do not
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def send_body(self, body: bytes, status: int = 200, content_type: str = 'application/octet-stream'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def send_limit_error(self, exceeded: str):
+        reason = f'{exceeded} API request limit exceeded. Please try again later.'
+        self.send_body(json.dumps({'error': True, 'reason': reason}).encode(), 429, 'application/json')
+
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        query = parse_qs(urlparse(self.path).query)
+
+        if urlparse(self.path).path.endswith('/history/city'):
+            self.send_open_weather(query)
+            return
+
+        lats = [float(lat) for value in query['latitude'] for lat in value.split(',')]
+        lons = [float(lon) for value in query['longitude'] for lon in value.split(',')]
+        # Like the api, hours start at local midnight of Europe/Moscow (utc_offset of encode_response)
+        start = int(datetime.fromisoformat(query['start_date'][0]).replace(tzinfo=timezone.utc).timestamp()) - 10800
+        end = int(datetime.fromisoformat(query['end_date'][0]).replace(tzinfo=timezone.utc).timestamp()) + 86400 - 10800
+
+        exceeded = self.server.take(request_weight(len(lats), len(query['hourly']), (end - start) // 86400))
+        if exceeded:
+            self.send_limit_error(exceeded)
+            return
+
+        body = b''.join(encode_response(lat, lon, start, end, len(query['hourly']), location_id=i, seed=location_seed(lat, lon)) for i, (lat, lon) in enumerate(zip(lats, lons)))
+        self.send_body(body)
+
+
+    def send_open_weather(self, query: dict):
+        """
+        OpenWeather history: one record per hour from start to end inclusive
+        """
+
+        exceeded = self.server.take(1)
+        if exceeded:
+            self.send_limit_error(exceeded)
+            return
+
+        records = [{
+            'dt': dt,
+            'main': {'temp': round(float(np.random.normal(5, 10)), 2), 'feels_like': 3.1, 'pressure': 1012, 'humidity': 80, 'temp_min': 2.5, 'temp_max': 6.5},
+            'wind': {'speed': 3.6, 'deg': 220, 'gust': 7.2},
+            'clouds': {'all': 75},
+            'weather': [{'id': 803, 'main': 'Clouds', 'description': 'broken clouds', 'icon': '04n'}]
+        } for dt in range(int(query['start'][0]), int(query['end'][0]) + 1, 3600)]
+        self.send_body(json.dumps({'message': 'Count: 24', 'cod': '200', 'city_id': int(query['id'][0]), 'cnt': len(records), 'list': records}).encode(), content_type='application/json')
+
+
+    def do_POST(self):
+        """
+        Dadata geolocate: cities west of 40 degrees longitude are in central federal district
+        Like Dadata, exceeded Daily limit is 403 and other limits are too many requests (429)
+        """
+
+        time.sleep(self.server.latency)
+        data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+
+        exceeded = self.server.take(1)
+        if exceeded:
+            self.send_body(json.dumps({'detail': f'{exceeded} quota exceeded'}).encode(), 403 if exceeded == 'Daily' else 429, 'application/json')
+            return
+
+        district = 'Центральный' if data['lon'] < 40 else 'Приволжский'
+        suggestion = {'value': 'address', 'data': {'federal_district': district, 'region_with_type': f'Region {int(data['lon'] * 10) % 18}'}}
+        self.send_body(json.dumps({'suggestions': [suggestion]}, ensure_ascii=False).encode(), content_type='application/json')
+
+
+class MockServer:
+    """
+    Local stand-in for Open-Meteo, OpenWeather history and Dadata geolocate apis, runs in a background thread
+    """
+
+    def __init__(self, latency: float = 0, limits: dict | None = None):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), MockHandler)
+        self.server.latency = latency
+        self.server.take = self.take
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+        # Limits are enforced over sliding windows of {name: (api calls, seconds)}
+        self.limits = limits or {}
+        self.calls = {name: deque() for name in self.limits}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.rejected = 0
+
+
+    def take(self, weight: float) -> str:
+        """
+        Count request weight against every limit and return name of exceeded limit
+        """
+
+        with self.lock:
+            now = time.time()
+            self.requests += 1
+
+            for name, (limit, period) in self.limits.items():
+                calls = self.calls[name]
+                while calls and calls[0][0] <= now - period:
+                    calls.popleft()
+                if sum(w for _, w in calls) + weight > limit:
+                    self.rejected += 1
+                    return name
+
+            for name in self.limits:
+                self.calls[name].append((now, weight))
+
+        return ''
+
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def bench_session(n_requests: int = 200, latency: float = 0):
+    """
+    Compare a new cache session and client per request with the shared HttpSession
+    Every request uses different coordinates, so the cache never answers and only the session overhead is measured
+    """
+
+    params = {"start_date": "2024-01-01", "end_date": "2024-01-07", "hourly": ["temperature_2m", "rain"]}
+
+    with MockServer(latency) as server, tempfile.TemporaryDirectory() as tmp:
+        url = f'{server.url}/v1/archive'
+
+        start = time.perf_counter()
+        for i in range(n_requests):
+            cache_session = requests_cache.CachedSession(os.path.join(tmp, 'per_request'), expire_after = -1)
+            retry_session = retry(cache_session, retries = 5, backoff_factor = 0.2)
+            openmeteo = openmeteo_requests.Client(session = retry_session)
+            openmeteo.weather_api(url, params={**params, "latitude": 50 + i / 1000, "longitude": 37})
+            cache_session.close()
+        per_request = (time.perf_counter() - start) / n_requests
+
+        session = HttpSession(cache_name=os.path.join(tmp, 'shared'))
+        start = time.perf_counter()
+        for i in range(n_requests):
+            session.openmeteo.weather_api(url, params={**params, "latitude": 50 + i / 1000, "longitude": 37})
+        shared = (time.perf_counter() - start) / n_requests
+        stats = session.stats()
+        session.close()
+
+    print(f'Session per request: {per_request * 1000:.2f} ms/request')
+    print(f'Shared session: {shared * 1000:.2f} ms/request ({(per_request - shared) * 1000:.2f} ms saved)')
+    print(f'Shared session stats: {stats}')
+
+
+def bench_async(n_requests: int = 200, concurrency: int = 8, latency: float = 0.05, n_cities: int = 18, batch_size: int | None = None):
+    """
+    Run the async engine against a mock server enforcing scaled down Open-Meteo limits
+    and compare with sequential requests, no request should be rejected with 429
+    Then get_weather_async sends chunks of different weight and a second run continues
+    with a new scheduler from the saved quota state, neither of them may burst past the limits
+    """
+
+    cwd = os.getcwd()
+    limits = {'Minutely': (60, 3), 'Hourly': (150, 12)}
+    params = {"start_date": "2024-01-01", "end_date": "2024-01-07", "hourly": ["temperature_2m", "rain"]}
+    cities = [{'id': i, 'name': f'City {i}', 'coord': {'lat': 50 + i / 10, 'lon': 37}} for i in range(n_cities)]
+
+    with MockServer(latency, limits) as server, tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+
+        try:
+            session = HttpSession(cache_name='cache', pool_maxsize=concurrency)
+            scheduler = QuotaScheduler(limits, state_file='quota.json')
+            tasks = [(1, lambda i=i: session.openmeteo.weather_api(f'{server.url}/v1/archive', params={**params, "latitude": 50 + i / 1000, "longitude": 37})) for i in range(n_requests)]
+
+            start = time.perf_counter()
+            results = AsyncFetcher(scheduler, concurrency).fetch(tasks)
+            elapsed = time.perf_counter() - start
+            engine = {'requests': server.requests, 'rejected': server.rejected}
+
+            with open('cfo.list.json', 'w') as file:
+                json.dump(cities, file)
+
+            # Chunks are heavier than the burst of the buckets, the second run starts with the quota spent by the first one
+            pending = []
+            for startdate, enddate in [('2024-02-01', '2024-03-31'), ('2024-04-01', '2024-05-30')]:
+                parser = WeatherParser(startdate, enddate, session=session)
+                parser.schema = DatasetSchema(WEATHER_SCHEMA.name, f'{server.url}/v1/archive', WEATHER_SCHEMA.variables)
+                with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                    pending.append(parser.get_weather_async(batch_size, concurrency, QuotaScheduler(limits, state_file='quota.json')))
+            session.close()
+        finally:
+            os.chdir(cwd)
+
+    assert engine['rejected'] == 0 and results.count(None) == 0
+    assert server.rejected == 0 and pending == [0, 0]
+
+    print(f'Async engine: {n_requests} requests in {elapsed:.2f} s, {n_requests / elapsed:.1f} requests/s')
+    print(f'Failed: {results.count(None)}, server requests: {engine['requests']}, rejected with 429: {engine['rejected']}')
+    print(f'get_weather_async of {n_cities} cities in two runs sharing the quota state: {server.requests - engine['requests']} requests, rejected with 429: {server.rejected}')
+    print(f'Mock server limits: {limits}')
+
+
+def bench_batch(n_pairs: int = 4, n_single: int = 4, batch_size: int = 3, resolution: float = 0.5, startdate: str = '2024-01-01', enddate: str = '2024-01-31'):
+    """
+    Load weather of cities sharing and not sharing grid points with batch_size points per api call against the mock server
+    Mock values depend only on the location, so every city file is compared with the series of its own grid point
+    """
+
+    cwd = os.getcwd()
+    # Cities of a pair are 0.1° apart in one grid cell, single cities have cells of their own
+    cities = [{'id': i, 'name': f'City {i}', 'coord': {'lat': 50 + i // 2 + i % 2 / 10, 'lon': 35 + i // 2}} for i in range(2 * n_pairs)]
+    cities += [{'id': 2 * n_pairs + i, 'name': f'City {2 * n_pairs + i}', 'coord': {'lat': 45 + i, 'lon': 40 + i}} for i in range(n_single)]
+    grid = GridIndex(resolution)
+    batches = grid.batches(list(enumerate(cities)), batch_size)
+
+    start = int(datetime.fromisoformat(startdate).replace(tzinfo=timezone.utc).timestamp()) - 10800
+    end = int(datetime.fromisoformat(enddate).replace(tzinfo=timezone.utc).timestamp()) + 86400 - 10800
+
+    with MockServer() as server, tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+
+        try:
+            with open('cfo.list.json', 'w') as file:
+                json.dump(cities, file)
+
+            session = HttpSession(cache_name='cache')
+            parser = WeatherParser(startdate, enddate, session=session, resolution=resolution)
+            parser.schema = DatasetSchema(WEATHER_SCHEMA.name, f'{server.url}/v1/archive', WEATHER_SCHEMA.variables)
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                pending = parser.get_weather(batch_size)
+            session.close()
+
+            files = {city['id']: parser.storage.read(f'weather_by_city/{startdate}_{enddate}_{city['id']}.csv') for city in cities}
+        finally:
+            os.chdir(cwd)
+
+    # One api call per chunk of grid points, cities sharing a point are requested once
+    assert pending == 0 and server.requests == len(batches)
+
+    for city in cities:
+        lat, lon = grid.point(city)
+        expected = WEATHER_SCHEMA.to_frame(WeatherApiResponse.GetRootAs(encode_response(lat, lon, start, end, len(WEATHER_SCHEMA.variables), seed=location_seed(lat, lon)), 4))
+        df = files[city['id']]
+        assert (pd.to_datetime(df['date']) == expected['date']).all()
+        assert np.array_equal(df[WEATHER_SCHEMA.names].to_numpy(np.float32), expected[WEATHER_SCHEMA.names].to_numpy())
+
+    print(f'Batched load of {len(cities)} cities, {len(grid.group(list(enumerate(cities))))} grid points, {batch_size} points per call: '
+          f'{server.requests} requests, every city file matches its grid point')
+
+
+def bench_classify(n_cities: int = 12, workers: int = 4, latency: float = 0.01):
+    """
+    Classify cities concurrently against the mock Dadata enforcing 2 requests per second and a daily quota of 8 requests
+    Chunks of workers simultaneous requests get 429 and are retried, the run stops on 403 of the daily quota
+    and the next run continues from the checkpoint without requesting classified cities again
+    """
+
+    cwd = os.getcwd()
+    cities = [{'id': i, 'name': f'City {i}', 'state': '', 'country': 'RU', 'coord': {'lat': 50 + i / 10, 'lon': 35 + i * 10 / n_cities}} for i in range(n_cities)]
+    args = ('city.list.json', 'cfo.list.json', 'city.not.found.json')
+    kwargs = {'checkpoint_every': workers, 'workers': workers, 'requests_per_second': 1000}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+
+        try:
+            with open('city.list.json', 'w') as file:
+                json.dump(cities, file)
+
+            with MockServer(latency, {'Second': (2, 1), 'Daily': (8, 86400)}) as server, open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                session = HttpSession(cache_name='cache', dadata_url=f'{server.url}/suggestions/api/4_1/rs/')
+                start = time.perf_counter()
+                first_pending = DadataParser('token', timeout=0, session=session).get_cfo_cities(*args, **kwargs)
+                first_seconds = time.perf_counter() - start
+                session.close()
+            first = {'requests': server.requests, 'rejected': server.rejected, 'checkpoint': json.load(open('cfo.checkpoint.json'))}
+
+            with MockServer(latency) as server, open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                session = HttpSession(cache_name='cache', dadata_url=f'{server.url}/suggestions/api/4_1/rs/')
+                second_pending = DadataParser('token', timeout=0, session=session).get_cfo_cities(*args, **kwargs)
+                session.close()
+            second_requests = server.requests
+
+            with open('cfo.list.json') as file:
+                cfo_list = json.load(file)
+        finally:
+            os.chdir(cwd)
+
+    # 8 cities fit into the daily quota, 429 of every chunk are retried and the third chunk stops on 403
+    assert first['checkpoint'] == list(range(8)) and first_pending == n_cities - 8
+    assert first['rejected'] > 4
+    # Resumed run requests only cities missing from the checkpoint
+    assert second_requests == n_cities - 8 and second_pending == 0
+    # Results are in input order and match the mock districts
+    assert [city['id'] for city in cfo_list] == [city['id'] for city in cities if city['coord']['lon'] < 40]
+
+    print(f'Classify {n_cities} cities with {workers} workers: first run {first_seconds:.2f} s, {first['requests']} requests, rejected {first['rejected']}, stopped by quota after 8 cities')
+    print(f'Resumed run: {second_requests} requests, {len(cfo_list)} cities in central federal district in input order')
+
+
+WEATHER_VARIABLES = ["temperature_2m", "relative_humidity_2m", "rain", "snowfall", "snow_depth", "surface_pressure", "cloud_cover", "wind_speed_10m", "wind_direction_10m"]
+
+
+def make_city_files(directory: str, n_files: int = 1000, n_hours: int = 24 * 30):
+    """
+    Write synthetic weather csv per city and cfo.list.json describing the cities into directory
+    """
+
+    os.makedirs(f'{directory}/weather_by_city', exist_ok=True)
+    dates = pd.date_range('2024-01-01 03:00', periods=n_hours, freq='h', tz='UTC')
+    cities = []
+
+    for city_id in range(n_files):
+        df = pd.DataFrame({variable: np.random.rand(n_hours).astype(np.float32) for variable in WEATHER_VARIABLES})
+        df.insert(0, 'date', dates)
+        df.to_csv(f'{directory}/weather_by_city/2024-01-01_2024-12-31_{city_id}.csv', index=False)
+        cities.append({'id': city_id, 'name': f'City {city_id}', 'region': f'Region {city_id % 18}', 'country': 'RU', 'coord': {'lat': 50 + city_id / 1000, 'lon': 37 + city_id / 1000}})
+
+    with open(f'{directory}/cfo.list.json', 'w') as file:
+        json.dump(cities, file)
+
+
+def legacy_merge(directory: str, file_to_save: str):
+    """
+    Merge as it was done before: json is parsed and dates are converted for every file, every file is appended to csv
+    """
+
+    for filename in os.listdir(directory):
+        df = pd.read_csv(f'{directory}/{filename}')
+        city_id = int(filename[:-4].split('_')[2])
+
+        with open('cfo.list.json') as file:
+            city = [city for city in json.load(file) if int(city['id']) == city_id][0]
+
+        df['year'] = pd.DatetimeIndex(df['date']).year
+        df['month'] = pd.DatetimeIndex(df['date']).month
+        df['day'] = pd.DatetimeIndex(df['date']).day
+        df['hour'] = pd.DatetimeIndex(df['date']).hour
+        df['city_id'] = city_id
+        df['city_name'] = city['name']
+        df['region'] = city['region']
+        df['lat'] = city['coord']['lat']
+        df['lon'] = city['coord']['lon']
+
+        if not os.path.isfile(file_to_save):
+            df.to_csv(file_to_save, mode='w', header=True)
+        else:
+            df.to_csv(file_to_save, mode='a', header=False)
+
+
+def bench_merge(n_files: int = 1000, n_hours: int = 24 * 30, workers: int = os.cpu_count()):
+    """
+    Compare per-file merge with the batched vectorized MergeCsv on synthetic city files
+    """
+
+    cwd = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        make_city_files(tmp, n_files, n_hours)
+        os.chdir(tmp)
+
+        try:
+            start = time.perf_counter()
+            legacy_merge('weather_by_city', 'legacy.csv')
+            legacy = time.perf_counter() - start
+
+            start = time.perf_counter()
+            MergeCsv('weather_by_city', 'merged.csv').merge_csv_files()
+            batched = time.perf_counter() - start
+
+            start = time.perf_counter()
+            MergeCsv('weather_by_city', 'parallel.csv').merge_csv_files(workers=workers)
+            parallel = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+
+    print(f'Merge of {n_files} files, {n_files * n_hours} rows')
+    print(f'Per-file merge: {legacy:.2f} s, batched merge: {batched:.2f} s, speedup {legacy / batched:.1f}x')
+    print(f'Batched merge with {workers} workers: {parallel:.2f} s, speedup {legacy / parallel:.1f}x')
+
+
+def bench_join(n_cities: int = 50, n_hours: int = 24 * 60, chunk_rows: int = 10000):
+    """
+    Compare in-memory pd.merge on ten keys with the streaming JoinDatasets on synthetic merged files
+    Air quality has no data for the first city and its hours are shifted, so partitions overlap only partly
+    """
+
+    cwd = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        make_city_files(tmp, n_cities, n_hours)
+        os.chdir(tmp)
+
+        try:
+            os.makedirs('air_quality_by_city')
+            dates = pd.date_range('2024-01-05 03:00', periods=n_hours, freq='h', tz='UTC')
+            for city_id in range(1, n_cities):
+                df = pd.DataFrame({variable: np.random.rand(n_hours).astype(np.float32) for variable in AIR_QUALITY_SCHEMA.names})
+                df.insert(0, 'date', dates)
+                df.to_csv(f'air_quality_by_city/2024-01-01_2024-12-31_{city_id}.csv', index=False)
+
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                MergeCsv('weather_by_city', 'weather_data.csv').merge_csv_files()
+                MergeCsv('air_quality_by_city', 'air_data.csv').merge_csv_files()
+
+            start = time.perf_counter()
+            in_memory = pd.merge(pd.read_csv('weather_data.csv'), pd.read_csv('air_data.csv'),
+                                 on=['date', 'year', 'month', 'day', 'hour', 'city_id', 'city_name', 'region', 'lat', 'lon'])
+            merge_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                JoinDatasets('weather_data.csv', 'air_data.csv', 'air_weather_data.csv', chunk_rows=chunk_rows).join(batch_rows=chunk_rows)
+            join_seconds = time.perf_counter() - start
+            streamed = pd.read_csv('air_weather_data.csv')
+        finally:
+            os.chdir(cwd)
+
+    in_memory = in_memory.sort_values(['city_id', 'date'], ignore_index=True)
+    assert len(in_memory) == (n_cities - 1) * (n_hours - 96)
+    assert streamed.equals(in_memory)
+
+    print(f'Join of {n_cities} cities, {len(streamed)} rows')
+    print(f'In-memory merge: {merge_seconds:.2f} s, streaming join: {join_seconds:.2f} s, outputs are equal')
+
+
+def legacy_process_response(response, variables: list[str]) -> pd.DataFrame:
+    """
+    Decode as it was done before: one ValuesAsNumpy array per variable copied into a dict, dates built with date_range
+    """
+
+    hourly = response.Hourly()
+    values = [hourly.Variables(k).ValuesAsNumpy() for k in range(len(variables))]
+
+    hourly_data = {"date": pd.date_range(
+        start = pd.to_datetime(hourly.Time(), unit = "s", utc = True) + pd.Timedelta(hours=3),
+        end = pd.to_datetime(hourly.TimeEnd(), unit = "s", utc = True) + pd.Timedelta(hours=3),
+        freq = pd.Timedelta(seconds = hourly.Interval()),
+        inclusive = "left"
+    )}
+    for variable, value in zip(variables, values):
+        hourly_data[variable] = value
+
+    return pd.DataFrame(data = hourly_data)
+
+
+def bench_decode(n_responses: int = 500, n_days: int = 365):
+    """
+    Compare per-variable decoding with schema extraction into one float32 array on synthetic FlatBuffers responses
+    """
+
+    start = int(datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()) - 10800
+
+    for schema in [WEATHER_SCHEMA, AIR_QUALITY_SCHEMA]:
+        message = encode_response(55.75, 37.62, start, start + n_days * 86400, len(schema.variables))
+        response = WeatherApiResponse.GetRootAs(message, 4)
+
+        legacy_df, schema_df = legacy_process_response(response, schema.names), schema.to_frame(response)
+        assert legacy_df.equals(schema_df)
+
+        timings = {}
+        for name, decode in [('per-variable', lambda: legacy_process_response(response, schema.names)), ('schema', lambda: schema.to_frame(response))]:
+            begin = time.perf_counter()
+            for _ in range(n_responses):
+                decode()
+            timings[name] = (time.perf_counter() - begin) / n_responses * 1000
+
+        print(f'Decode {schema.name}: {len(schema.variables)} variables x {n_days * 24} hours, {n_responses} responses')
+        print(f'Per-variable: {timings['per-variable']:.3f} ms, schema: {timings['schema']:.3f} ms per response, speedup {timings['per-variable'] / timings['schema']:.1f}x')
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident memory of this process since the last reset_peak_rss
+    """
+
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS and is never reset
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        pass
+
+
+def count_rows(path: str) -> int:
+    """
+    Number of data rows of csv file or of all csv files of directory, number of records of json file
+    """
+
+    if path.endswith('.json'):
+        with open(path) as file:
+            return len(json.load(file))
+
+    filenames = [os.path.join(path, filename) for filename in os.listdir(path) if filename.endswith('.csv')] if os.path.isdir(path) else [path]
+    rows = 0
+    for filename in filenames:
+        with open(filename, 'rb') as file:
+            rows += file.read().count(b'\n') - 1
+
+    return rows
+
+
+def run_stage(name: str, stage, output: str, server: MockServer) -> dict:
+    """
+    Run stage and measure time, mock server requests and peak memory, rows are counted in output file or directory afterwards
+    Stage returns number of items left unprocessed like the pipeline stages, None counts as 0
+    Parser progress output is discarded, so printing does not dominate the report
+    """
+
+    reset_peak_rss()
+    requests = server.requests
+
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        pending = stage() or 0
+    elapsed = time.perf_counter() - start
+
+    return {'stage': name, 'seconds': elapsed, 'requests': server.requests - requests, 'rows': count_rows(output), 'pending': pending, 'peak_rss_mb': peak_rss_mb()}
+
+
+def bench_pipeline(n_cities: int = 100, startdate: str = '2024-01-01', enddate: str = '2024-12-31', latency: float = 0.02,
+                   batch_size: int = 10, concurrency: int = 8, workers: int = os.cpu_count()):
+    """
+    Run the whole pipeline against the mock server: Dadata classification of city.list.json,
+    Open-Meteo weather and air quality, merge of weather files and one month of OpenWeather history
+    Mock server runs in this process, so its time and memory are included in the stages
+    """
+
+    cwd = os.getcwd()
+    cities = [{'id': i, 'name': f'City {i}', 'state': '', 'country': 'RU' if i % 10 else 'UA',
+               'coord': {'lat': 50 + (i % 50) / 10, 'lon': 35 + i * 10 / n_cities}} for i in range(n_cities)]
+
+    with MockServer(latency) as server, tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+
+        try:
+            with open('city.list.json', 'w') as file:
+                json.dump(cities, file)
+
+            session = HttpSession(cache_name='cache', pool_maxsize=concurrency, dadata_url=f'{server.url}/suggestions/api/4_1/rs/')
+            stages = []
+
+            dadata_parser = DadataParser('token', timeout=0, session=session)
+            stages.append(run_stage('Dadata get_cfo_cities', lambda: dadata_parser.get_cfo_cities('city.list.json', 'cfo.list.json', 'city.not.found.json',
+                                                                                                  workers=concurrency, requests_per_second=1000), 'cfo.list.json', server))
+
+            weather_parser = WeatherParser(startdate, enddate, session=session)
+            weather_parser.schema = DatasetSchema(WEATHER_SCHEMA.name, f'{server.url}/v1/archive', WEATHER_SCHEMA.variables)
+            stages.append(run_stage('WeatherParser get_weather', lambda: weather_parser.get_weather(batch_size), 'weather_by_city', server))
+
+            air_quality_parser = AirQualityParser(startdate, enddate, session=session)
+            air_quality_parser.schema = DatasetSchema(AIR_QUALITY_SCHEMA.name, f'{server.url}/v1/air-quality', AIR_QUALITY_SCHEMA.variables)
+            stages.append(run_stage('AirQualityParser get_air_quality', lambda: air_quality_parser.get_air_quality(batch_size), 'air_quality_by_city', server))
+
+            merge = MergeCsv('weather_by_city', 'weather_data.csv')
+            stages.append(run_stage('MergeCsv merge_csv_files', lambda: merge.merge_csv_files(workers=workers), 'weather_data.csv', server))
+
+            start = int(datetime.fromisoformat(startdate).replace(tzinfo=timezone.utc).timestamp())
+            open_weather_parser = OpenWeatherParser('token', session=session)
+            open_weather_parser.url = f'{server.url}/data/2.5/history/city'
+            stages.append(run_stage('OpenWeatherParser load_weather_by_city', lambda: open_weather_parser.load_weather_by_city(start, start + 30 * 86400, workers=concurrency, requests_per_second=1000),
+                                    'open_weather_by_city', server))
+
+            session.close()
+        finally:
+            os.chdir(cwd)
+
+    print(f'Pipeline on {n_cities} cities, {startdate} - {enddate}, mock latency {latency * 1000:.0f} ms')
+    print(f'{"Stage":<40}{"seconds":>10}{"requests":>10}{"req/s":>10}{"rows":>12}{"rows/s":>12}{"pending":>10}{"peak RSS MB":>13}')
+    for stage in stages:
+        print(f'{stage['stage']:<40}{stage['seconds']:>10.2f}{stage['requests']:>10}{stage['requests'] / stage['seconds']:>10.1f}'
+              f'{stage['rows']:>12}{stage['rows'] / stage['seconds']:>12.0f}{stage['pending']:>10}{stage['peak_rss_mb']:>13.1f}')
+
+
+if __name__ == '__main__':
+    bench_session()
+    bench_async()
+    bench_batch()
+    bench_classify()
+    bench_merge()
+    bench_join()
+    bench_decode()
+    bench_pipeline()
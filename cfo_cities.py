@@ -1,30 +1,80 @@
-from dadata import Dadata
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import time
 import json
+import os.path
+
+from http_session import HttpSession, get_session
+from city_index import get_city_index
+from geocode_cache import GeocodeCache
+from async_fetch import RateLimiter
+from metrics import get_metrics
 
 
 class DadataParser:
-    def __init__(self, token: str, timeout: float = 1):
+    def __init__(self, token: str, timeout: float = 1, session: HttpSession | None = None, geocode_cache: GeocodeCache | None = None):
         self.token = token
-        self.dadata = Dadata(self.token)
+        self.session = session or get_session()
+        self.dadata = self.session.get_dadata(self.token)
         self.timeout = timeout
+        self.geocode_cache = geocode_cache or GeocodeCache()
+        self.metrics = get_metrics()
 
 
     def __check_cfo(self, lat: float, lon: float) -> str:
         """
-        Get federal dictrict by coordinates and return federal dictrict name
-        Try-except is used when city is not found
+        Get federal dictrict and region by coordinates with one geocode request
+        Answers are cached by rounded coordinates, cached coordinates cost no request and no timeout
+        Empty strings are returned when city is not found, failed requests raise and are not cached
         """
 
-        try:
-            cfo = self.dadata.geolocate(name="address", count=1, radius_meters=1000, lat=lat, lon=lon)[0]['data']['federal_district']
-            region = self.dadata.geolocate(name="address", count=1, radius_meters=1000, lat=lat, lon=lon)[0]['data']['region_with_type']
-        except Exception:
-            cfo, region = '', ''
+        cached = self.geocode_cache.get(lat, lon)
+        if cached is not None:
+            return cached
+
+        cfo, region = self.__geolocate(lat, lon)
 
         time.sleep(self.timeout)
-        return (cfo.strip(), region.strip())
+        return (cfo, region)
+
+
+    def __geolocate(self, lat: float, lon: float) -> tuple:
+        with self.metrics.timer('http_request_seconds', host='suggestions.dadata.ru', cache='miss'):
+            suggestions = self.dadata.geolocate(name="address", count=1, radius_meters=1000, lat=lat, lon=lon)
+        self.metrics.inc('http_requests_total', host='suggestions.dadata.ru', cache='miss')
+        data = suggestions[0]['data'] if suggestions else {}
+        cfo, region = (data.get('federal_district') or '').strip(), (data.get('region_with_type') or '').strip()
+        self.geocode_cache.set(lat, lon, (cfo, region))
+
+        return (cfo, region)
+
+
+    def lookup_city(self, city: dict, limiter: RateLimiter, stop: threading.Event, attempts: int = 3) -> tuple | None:
+        """
+        Geocode city in a worker thread, requests of all workers are paced by one limiter
+        Too many requests (429) are retried, other errors set stop, so the other workers do not spend quota
+        Return None when the run is stopped
+        """
+
+        lat, lon = city['coord']['lat'], city['coord']['lon']
+        cached = self.geocode_cache.get(lat, lon)
+        if cached is not None:
+            return cached
+
+        for attempt in range(1, attempts + 1):
+            if stop.is_set():
+                return None
+
+            limiter.wait()
+            try:
+                return self.__geolocate(lat, lon)
+            except Exception as e:
+                if getattr(getattr(e, 'response', None), 'status_code', None) != 429 or attempt == attempts:
+                    stop.set()
+                    raise
+                self.metrics.inc('retries_total', dataset='cfo')
+                time.sleep(attempt)
 
 
     def open_json(self, filename: str) -> list[dict]:
@@ -51,19 +101,61 @@ class DadataParser:
             json.dump(data, file, indent=4)
 
 
-    def get_cfo_cities(self, city_list_filename: str, cfo_list_filename: str, city_not_found_filename: str):
+    def save_progress(self, cfo_list_filename: str, cfo_list: list[dict], city_not_found_filename: str, city_not_found_list: list[dict], checkpoint_filename: str, processed: set):
+        """
+        Write results before processed ids, so a city is never marked processed without its result
+        """
+
+        self.write_json(cfo_list_filename, cfo_list)
+        self.write_json(city_not_found_filename, city_not_found_list)
+        self.write_json(checkpoint_filename, sorted(processed))
+        self.geocode_cache.save()
+
+
+    def add_result(self, city: dict, cfo: str, region: str, cfo_list: list[dict], city_not_found_list: list[dict], processed: set):
+        if cfo == 'Центральный':
+            cfo_city = {key: value for key, value in city.items() if key != 'state'}
+            cfo_city['region'] = region
+            cfo_list.append(cfo_city)
+        elif not cfo:
+            city_not_found_list.append(city)
+            print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: city not found {city}')
+
+        processed.add(city['id'])
+        self.metrics.inc('cities_classified_total', found=str(bool(cfo)))
+
+
+    def get_cfo_cities(self, city_list_filename: str, cfo_list_filename: str, city_not_found_filename: str, checkpoint_filename: str = 'cfo.checkpoint.json', checkpoint_every: int = 100,
+                       workers: int = 1, requests_per_second: float = 10):
         """
         Find cities in central federal district and save to json
-        Try-except is applied in cases when number of api requests is exceeded
+        Progress is kept by city id: cities from cfo list, not found list and checkpoint are skipped,
+        so a run stopped when number of api requests is exceeded continues from where it stopped
+        Results are checkpointed every checkpoint_every requested cities
+        With several workers cities are geocoded concurrently, at most requests_per_second requests per second
+        Return number of cities left unclassified, it is not 0 when the run stopped on an api error
         """
 
-        city_not_found_list = []
-        city_list, cfo_list = self.open_json(city_list_filename), self.open_json(cfo_list_filename)
-        ru_city_list_len = len([city for city in city_list if city['country'] == 'RU'])
-        
+        stage_start = time.perf_counter()
+        city_list = self.open_json(city_list_filename)
+        cfo_list = list(get_city_index(cfo_list_filename).cities)
+        city_not_found_list = self.open_json(city_not_found_filename) if os.path.isfile(city_not_found_filename) else []
+        checkpoint = self.open_json(checkpoint_filename) if os.path.isfile(checkpoint_filename) else []
+
+        # Ids of every classified city: cfo, other districts and not found
+        processed = set(checkpoint) | {city['id'] for city in cfo_list} | {city['id'] for city in city_not_found_list}
+        ru_city_list_len = len([city for city in city_list if city['country'] == 'RU' and city['id'] not in processed])
+
+        if workers > 1:
+            pending = [(i, city) for i, city in enumerate(city_list) if city['country'] == 'RU' and city['id'] not in processed]
+            self.classify_concurrently(pending, len(city_list), cfo_list, city_not_found_list, processed, workers, requests_per_second, checkpoint_every,
+                                       lambda: self.save_progress(cfo_list_filename, cfo_list, city_not_found_filename, city_not_found_list, checkpoint_filename, processed))
+            self.metrics.observe('stage_seconds', time.perf_counter() - stage_start, sample=False, stage='get_cfo_cities')
+            return len([city for city in city_list if city['country'] == 'RU' and city['id'] not in processed])
+
         n = 0
         for i in range(len(city_list)):
-            if city_list[i]['country'] == 'RU' and city_list[i] not in cfo_list:
+            if city_list[i]['country'] == 'RU' and city_list[i]['id'] not in processed:
                 n += 1
 
                 try:
@@ -72,18 +164,53 @@ class DadataParser:
                     print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}:\n{e}')
                     break
 
-                if cfo == 'Центральный':
-                    city_list[i]['region'] = region
-                    del city_list[i]['state']
-                    cfo_list.append(city_list[i])
-                elif not cfo:
-                    city_not_found_list.append(city_list[i])
-                    print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: city not found {city_list[i]}')
-                
+                self.add_result(city_list[i], cfo, region, cfo_list, city_not_found_list, processed)
                 print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: ru_cities: {n}/{ru_city_list_len} all_cities: {i}/{len(city_list)} City: {city_list[i]['name']} CFO: {cfo}')
 
-        self.write_json(cfo_list_filename, cfo_list)
-        self.write_json(city_not_found_filename, city_not_found_list)
+                if n % checkpoint_every == 0:
+                    self.save_progress(cfo_list_filename, cfo_list, city_not_found_filename, city_not_found_list, checkpoint_filename, processed)
+
+        self.save_progress(cfo_list_filename, cfo_list, city_not_found_filename, city_not_found_list, checkpoint_filename, processed)
+        self.metrics.observe('stage_seconds', time.perf_counter() - stage_start, sample=False, stage='get_cfo_cities')
+        return len([city for city in city_list if city['country'] == 'RU' and city['id'] not in processed])
+
+
+    def classify_concurrently(self, pending: list[tuple], n_cities: int, cfo_list: list[dict], city_not_found_list: list[dict], processed: set,
+                              workers: int, requests_per_second: float, checkpoint_every: int, save_progress):
+        """
+        Geocode pending (index, city) pairs in a thread pool, checkpoint_every cities at a time
+        Results of every chunk are added in input order and checkpointed,
+        the run stops after the chunk where a request failed
+        """
+
+        limiter = RateLimiter(requests_per_second)
+        stop = threading.Event()
+
+        with ThreadPoolExecutor(workers) as executor:
+            for k in range(0, len(pending), checkpoint_every):
+                chunk = pending[k:k + checkpoint_every]
+                futures = [executor.submit(self.lookup_city, city, limiter, stop) for _, city in chunk]
+                error = None
+
+                for n, ((i, city), future) in enumerate(zip(chunk, futures)):
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        error = error or e
+                        continue
+
+                    if result is None:
+                        continue
+
+                    cfo, region = result
+                    self.add_result(city, cfo, region, cfo_list, city_not_found_list, processed)
+                    print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: ru_cities: {k+n+1}/{len(pending)} all_cities: {i}/{n_cities} City: {city['name']} CFO: {cfo}')
+
+                save_progress()
+
+                if error is not None:
+                    print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}:\n{error}')
+                    break
 
 
 if __name__ == '__main__':
@@ -93,3 +220,4 @@ if __name__ == '__main__':
 
     dadata_parser = DadataParser(token, timeout=0.1)
     dadata_parser.get_cfo_cities('city.list.json', 'cfo.list.json', 'city.not.found.json')
+    get_metrics().export('metrics.prom')
@@ -0,0 +1,91 @@
+import json
+import os
+import pickle
+
+
+class CityIndex:
+    """
+    Cities from json list indexed by id
+    Parsed list is pickled next to the json file and reused until the json file changes
+    """
+
+    def __init__(self, filename: str = 'cfo.list.json', cache: bool = True):
+        self.filename = filename
+        self.cache_filename = f'{filename}.pickle'
+        self.mtime = os.path.getmtime(filename) if os.path.isfile(filename) else None
+        self.cities = self.load(cache)
+        self.by_id = {int(city['id']): city for city in self.cities}
+
+
+    def open_json(self, filename: str) -> list[dict]:
+        try:
+            with open(filename) as file:
+                data = json.load(file)
+        except Exception as e:
+            data = []
+            print(f'JSON file: {filename} is empty\n{e}')
+
+        return data
+
+
+    def load(self, cache: bool) -> list[dict]:
+        if cache and self.mtime is not None and os.path.isfile(self.cache_filename):
+            try:
+                with open(self.cache_filename, 'rb') as file:
+                    mtime, cities = pickle.load(file)
+                if mtime == self.mtime:
+                    return cities
+            except Exception:
+                pass
+
+        cities = self.open_json(self.filename)
+
+        if cache and self.mtime is not None:
+            with open(self.cache_filename, 'wb') as file:
+                pickle.dump((self.mtime, cities), file, protocol=pickle.HIGHEST_PROTOCOL)
+
+        return cities
+
+
+    def get(self, city_id: int) -> dict | None:
+        return self.by_id.get(int(city_id))
+
+
+    def get_info(self, city_id: int) -> tuple | None:
+        """
+        Return (city_name, region, lat, lon) with '' and 1000 for missing fields
+        """
+
+        city = self.get(city_id)
+        if city is None:
+            return None
+
+        city_name = city['name'] if 'name' in city.keys() else ''
+        region = city['region'] if 'region' in city.keys() else ''
+        lat = city['coord']['lat'] if 'coord' in city.keys() else 1000
+        lon = city['coord']['lon'] if 'coord' in city.keys() else 1000
+        return (city_name, region, lat, lon)
+
+
+    def __contains__(self, city_id) -> bool:
+        return int(city_id) in self.by_id
+
+
+    def __len__(self) -> int:
+        return len(self.cities)
+
+
+indexes = {}
+
+
+def get_city_index(filename: str = 'cfo.list.json') -> CityIndex:
+    """
+    Return index shared by all parsers, it is rebuilt only when the json file changes
+    """
+
+    mtime = os.path.getmtime(filename) if os.path.isfile(filename) else None
+
+    if filename not in indexes or indexes[filename].mtime != mtime:
+        indexes[filename] = CityIndex(filename)
+
+    return indexes[filename]
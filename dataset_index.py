@@ -0,0 +1,183 @@
+import pandas as pd
+import numpy as np
+
+import io
+import json
+import mmap
+import os
+
+from storage import CsvStorage
+
+
+class CsvIndex:
+    """
+    Sidecar index of merged csv sorted by city_id and date, saved to {filename}.index.json
+    Keeps byte range and number of rows of every city and month, so a slice is read with a few range reads
+    Index of a csv that was rewritten or removed since is discarded and built again by scanning the csv
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.index_filename = f'{filename}.index.json'
+        self.header = None
+        # [city_id, year * 100 + month, start byte, end byte, rows]
+        self.entries = []
+
+        try:
+            with open(self.index_filename) as file:
+                data = json.load(file)
+            if os.path.getsize(filename) == data['size']:
+                self.header, self.entries = data['header'], data['entries']
+        except Exception:
+            pass
+
+        # Rows appended to a csv without index must not be indexed from the end of the old rows
+        if self.header is None and os.path.isfile(filename) and os.path.getsize(filename):
+            self.scan()
+            self.save()
+
+
+    def scan(self, chunk_rows: int = 500000, block_size: int = 64 * 1024 * 1024):
+        """
+        Build index of the whole csv: row ends are found in blocks of the memory-mapped file,
+        city ids and months are read chunk_rows rows at a time
+        """
+
+        self.header, self.entries = None, []
+        ends = []
+        with open(self.filename, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for offset in range(0, len(data), block_size):
+                block = np.frombuffer(data, np.uint8, min(block_size, len(data) - offset), offset)
+                ends.append(np.flatnonzero(block == ord('\n')) + offset + 1)
+                del block
+        ends = np.concatenate(ends)
+        self.header = [0, int(ends[0])]
+
+        columns = pd.read_csv(self.filename, nrows=0).columns
+        usecols = ['city_id'] + (['year', 'month'] if 'year' in columns and 'month' in columns else ['date'])
+        first = 0
+        for df in pd.read_csv(self.filename, usecols=usecols, chunksize=chunk_rows):
+            rows = ends[first + 1:first + 1 + len(df)]
+            self.add(df, int(ends[first]), rows)
+            first += len(df)
+
+
+    def add(self, df: pd.DataFrame, start: int, ends: np.ndarray):
+        """
+        Add rows of df written from byte start, ends are offsets where every row ends
+        """
+
+        if self.header is None:
+            self.header = [0, start]
+        if not len(df):
+            return
+
+        city_ids = df['city_id'].to_numpy()
+        if 'year' in df.columns and 'month' in df.columns:
+            months = df['year'].to_numpy() * 100 + df['month'].to_numpy()
+        else:
+            dates = pd.DatetimeIndex(pd.to_datetime(df['date'], format='ISO8601'))
+            months = dates.year.to_numpy() * 100 + dates.month.to_numpy()
+
+        firsts = np.flatnonzero(np.r_[True, (city_ids[1:] != city_ids[:-1]) | (months[1:] != months[:-1])])
+        lasts = np.r_[firsts[1:], len(df)] - 1
+        starts = np.r_[start, ends[:-1]][firsts]
+
+        for first, last, range_start in zip(firsts, lasts, starts):
+            entry = [int(city_ids[first]), int(months[first]), int(range_start), int(ends[last]), int(last - first + 1)]
+            # City and month split between two batches is one entry
+            if self.entries and self.entries[-1][:2] == entry[:2] and self.entries[-1][3] == entry[2]:
+                self.entries[-1][3] = entry[3]
+                self.entries[-1][4] += entry[4]
+            else:
+                self.entries.append(entry)
+
+
+    def save(self):
+        with open(self.index_filename, 'w') as file:
+            json.dump({'size': os.path.getsize(self.filename), 'header': self.header, 'entries': self.entries}, file)
+
+
+    def ranges(self, city_ids: list[int] | None = None, start: str | None = None, end: str | None = None) -> list[tuple]:
+        """
+        Return byte ranges of cities and months overlapping start and end dates, adjacent ranges are joined
+        """
+
+        city_ids = set(city_ids) if city_ids else None
+        first_month = int(pd.Timestamp(start).strftime('%Y%m')) if start else 0
+        last_month = int(pd.Timestamp(end).strftime('%Y%m')) if end else 999999
+
+        ranges = []
+        for city_id, month, range_start, range_end, _ in self.entries:
+            if (city_ids is not None and city_id not in city_ids) or not first_month <= month <= last_month:
+                continue
+            if ranges and ranges[-1][1] == range_start:
+                ranges[-1] = (ranges[-1][0], range_end)
+            else:
+                ranges.append((range_start, range_end))
+
+        return ranges
+
+
+    def read(self, city_ids: list[int] | None = None, start: str | None = None, end: str | None = None, columns: list[str] | None = None) -> pd.DataFrame:
+        """
+        Read rows of cities between start and end dates from the memory-mapped csv, only indexed ranges are parsed
+        """
+
+        if self.header is None:
+            raise ValueError(f'{self.filename} has no index, merge it again with MergeCsv')
+
+        usecols = list(dict.fromkeys(columns + ['date'])) if columns else None
+        with open(self.filename, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            chunks = [data[self.header[0]:self.header[1]]] + [data[range_start:range_end] for range_start, range_end in self.ranges(city_ids, start, end)]
+        df = pd.read_csv(io.BytesIO(b''.join(chunks)), usecols=usecols)
+
+        # Months are read whole, rows outside of start and end dates are dropped here
+        if start or end:
+            dates = pd.to_datetime(df['date'], format='ISO8601')
+            dates = dates.dt.tz_localize(None) if dates.dt.tz is not None else dates
+            mask = pd.Series(True, index=df.index)
+            if start:
+                mask &= dates >= pd.Timestamp(start)
+            if end:
+                mask &= dates <= pd.Timestamp(end)
+            df = df[mask].reset_index(drop=True)
+
+        return df[columns] if columns else df
+
+
+class DatasetReader:
+    """
+    Reads city and time slices of merged data: indexed range reads of csv,
+    partition pruning by city_id and year with date filter pushdown of parquet and arrow datasets
+    """
+
+    def __init__(self, path: str, storage=None):
+        self.path = path
+        self.storage = storage or CsvStorage()
+        self.index = CsvIndex(path) if isinstance(self.storage, CsvStorage) else None
+
+
+    def read(self, city_ids: list[int] | None = None, start: str | None = None, end: str | None = None, columns: list[str] | None = None) -> pd.DataFrame:
+        """
+        Return rows of city_ids (all cities by default) with dates from start to end inclusive
+        """
+
+        if self.index is not None:
+            return self.index.read(city_ids, start, end, columns)
+
+        filters = []
+        if city_ids:
+            filters.append(('city_id', 'in', list(city_ids)))
+        # Dates are stored as UTC timestamps of local hours
+        if start:
+            filters += [('year', '>=', pd.Timestamp(start).year), ('date', '>=', pd.Timestamp(start, tz='UTC'))]
+        if end:
+            filters += [('year', '<=', pd.Timestamp(end).year), ('date', '<=', pd.Timestamp(end, tz='UTC'))]
+
+        return self.storage.read(self.path, columns=columns, filters=filters or None)
+
+
+if __name__ == '__main__':
+    reader = DatasetReader('weather_data.csv')
+    print(reader.read([int(reader.index.entries[0][0])], '2024-01-01', '2024-01-31 23:00'))
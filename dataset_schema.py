@@ -0,0 +1,117 @@
+import pandas as pd
+import numpy as np
+
+
+class DatasetSchema:
+    """
+    Open-Meteo dataset description: api url and hourly variables with units and dtypes
+    Variables are requested and extracted in the listed order, so adding a variable is one line in the schema
+    """
+
+    def __init__(self, name: str, url: str, variables: dict[str, tuple], timezone: str = 'Europe/Moscow'):
+        self.name = name
+        self.url = url
+        # {name: (unit, dtype)}
+        self.variables = variables
+        self.timezone = timezone
+        self.columns = pd.Index(self.names)
+
+
+    @property
+    def names(self) -> list[str]:
+        return list(self.variables)
+
+
+    @property
+    def units(self) -> dict[str, str]:
+        return {name: unit for name, (unit, _) in self.variables.items()}
+
+
+    def params(self, lats: list[float], lons: list[float], startdate: str, enddate: str) -> dict:
+        return {
+            "latitude": lats,
+            "longitude": lons,
+            "start_date": startdate,
+            "end_date": enddate,
+            "hourly": self.names,
+            "timezone": self.timezone
+        }
+
+
+    def dates(self, response) -> pd.DatetimeIndex:
+        """
+        Hourly timestamps in local time of the requested timezone, stored as UTC like the api client examples
+        """
+
+        hourly = response.Hourly()
+        offset = response.UtcOffsetSeconds()
+        microseconds = np.arange(hourly.Time() + offset, hourly.TimeEnd() + offset, hourly.Interval(), dtype=np.int64) * 1000000
+        return pd.DatetimeIndex(microseconds.view('datetime64[us]'), tz='UTC')
+
+
+    def to_frame(self, response) -> pd.DataFrame:
+        """
+        Copy all variables of response into one preallocated float32 array in a single pass
+        Data frame is a view of the array, columns with other dtypes in the schema are converted afterwards
+        """
+
+        hourly = response.Hourly()
+        if hourly.VariablesLength() != len(self.variables):
+            raise ValueError(f'{self.name}: {hourly.VariablesLength()} variables in response, {len(self.variables)} in schema')
+
+        dates = self.dates(response)
+        values = np.empty((len(self.variables), len(dates)), dtype=np.float32)
+        for k in range(len(self.variables)):
+            values[k] = hourly.Variables(k).ValuesAsNumpy()
+
+        # Transposed array is one column-major block, so pandas does not copy it
+        df = pd.DataFrame(values.T, columns=self.columns, copy=False)
+        df.insert(0, 'date', dates)
+
+        for name, (_, dtype) in self.variables.items():
+            if dtype != 'float32':
+                df[name] = df[name].astype(dtype)
+
+        return df
+
+
+    def drop_unpublished(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Drop trailing hours with every variable NaN, the api returns them for recent days it has not published yet
+        """
+
+        published = np.flatnonzero(df[self.names].notna().any(axis=1).to_numpy())
+        return df.iloc[:published[-1] + 1] if len(published) else df.iloc[:0]
+
+
+WEATHER_SCHEMA = DatasetSchema('weather', 'https://archive-api.open-meteo.com/v1/archive', {
+    'temperature_2m': ('°C', 'float32'),
+    'relative_humidity_2m': ('%', 'float32'),
+    'rain': ('mm', 'float32'),
+    'snowfall': ('cm', 'float32'),
+    'snow_depth': ('m', 'float32'),
+    'surface_pressure': ('hPa', 'float32'),
+    'cloud_cover': ('%', 'float32'),
+    'wind_speed_10m': ('km/h', 'float32'),
+    'wind_direction_10m': ('°', 'float32')
+})
+
+AIR_QUALITY_SCHEMA = DatasetSchema('air_quality', 'https://air-quality-api.open-meteo.com/v1/air-quality', {
+    'pm10': ('μg/m³', 'float32'),
+    'pm2_5': ('μg/m³', 'float32'),
+    'carbon_monoxide': ('μg/m³', 'float32'),
+    'carbon_dioxide': ('ppm', 'float32'),
+    'nitrogen_dioxide': ('μg/m³', 'float32'),
+    'sulphur_dioxide': ('μg/m³', 'float32'),
+    'ozone': ('μg/m³', 'float32'),
+    'alder_pollen': ('grains/m³', 'float32'),
+    'birch_pollen': ('grains/m³', 'float32'),
+    'grass_pollen': ('grains/m³', 'float32'),
+    'mugwort_pollen': ('grains/m³', 'float32'),
+    'olive_pollen': ('grains/m³', 'float32'),
+    'ragweed_pollen': ('grains/m³', 'float32'),
+    'european_aqi': ('EAQI', 'float32'),
+    'formaldehyde': ('μg/m³', 'float32'),
+    'pm10_wildfires': ('μg/m³', 'float32'),
+    'nitrogen_monoxide': ('μg/m³', 'float32')
+})
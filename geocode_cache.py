@@ -0,0 +1,47 @@
+import json
+import threading
+
+
+class GeocodeCache:
+    """
+    Coordinates to (federal district, region) cache kept in a json file
+    Coordinates are rounded to precision digits, so nearby settlements and reruns share one lookup
+    """
+
+    def __init__(self, filename: str = 'geocode.cache.json', precision: int = 2, save_every: int = 100):
+        self.filename = filename
+        self.precision = precision
+        self.save_every = save_every
+        self.unsaved = 0
+        self.lock = threading.Lock()
+
+        try:
+            with open(filename) as file:
+                self.data = json.load(file)
+        except Exception:
+            self.data = {}
+
+
+    def key(self, lat: float, lon: float) -> str:
+        return f'{round(lat, self.precision):.{self.precision}f},{round(lon, self.precision):.{self.precision}f}'
+
+
+    def get(self, lat: float, lon: float) -> tuple | None:
+        value = self.data.get(self.key(lat, lon))
+        return tuple(value) if value is not None else None
+
+
+    def set(self, lat: float, lon: float, value: tuple):
+        with self.lock:
+            self.data[self.key(lat, lon)] = list(value)
+            self.unsaved += 1
+
+        if self.unsaved >= self.save_every:
+            self.save()
+
+
+    def save(self):
+        with self.lock:
+            with open(self.filename, 'w') as file:
+                json.dump(self.data, file, ensure_ascii=False)
+            self.unsaved = 0
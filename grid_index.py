@@ -0,0 +1,65 @@
+from datetime import datetime
+
+from city_index import get_city_index
+
+
+class GridIndex:
+    """
+    Buckets cities into points of a regular lat/lon grid with resolution degrees step
+    Cities in one bucket get the same series from the api, so every point is requested once and shared by its cities
+    Without resolution coordinates are only rounded to 2 decimals as before, so only cities with equal coordinates share a point
+    Reanalysis grid of the weather archive is about 0.1-0.25°, CAMS Europe grid of air quality is 0.1°
+    """
+
+    def __init__(self, resolution: float | None = None):
+        self.resolution = resolution
+
+
+    def point(self, city: dict) -> tuple[float, float]:
+        lat, lon = city['coord']['lat'], city['coord']['lon']
+        if not self.resolution:
+            return (round(lat, 2), round(lon, 2))
+
+        return (round(round(lat / self.resolution) * self.resolution, 4), round(round(lon / self.resolution) * self.resolution, 4))
+
+
+    def group(self, cities: list[tuple]) -> dict[tuple, list[tuple]]:
+        """
+        Group (index, city) pairs by grid point keeping the order of first appearance
+        """
+
+        points = {}
+        for i, city in cities:
+            points.setdefault(self.point(city), []).append((i, city))
+
+        return points
+
+
+    def batches(self, cities: list[tuple], batch_size: int) -> list[list[tuple]]:
+        """
+        Split (index, city) pairs into chunks of batch_size grid points, cities sharing a point are kept in one chunk
+        """
+
+        groups = list(self.group(cities).values())
+        return [[pair for group in groups[k:k + batch_size] for pair in group] for k in range(0, len(groups), batch_size)]
+
+
+    def report(self, cities: list[tuple]) -> dict:
+        """
+        Return number of cities, number of grid points to request and dedup ratio: cities per requested point
+        """
+
+        n_points = len(self.group(cities))
+        return {'resolution': self.resolution, 'cities': len(cities), 'points': n_points, 'dedup_ratio': len(cities) / n_points if n_points else 1}
+
+
+    def print_report(self, cities: list[tuple], dataset: str):
+        report = self.report(cities)
+        print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: {dataset}: {report['cities']} cities, {report['points']} grid points, dedup ratio: {report['dedup_ratio']:.2f}')
+
+
+if __name__ == '__main__':
+    cities = list(enumerate(get_city_index('cfo.list.json').cities))
+    for resolution in (None, 0.05, 0.1, 0.25):
+        report = GridIndex(resolution).report(cities)
+        print(f'Resolution: {resolution or 0.01}° cities: {report['cities']} points: {report['points']} dedup ratio: {report['dedup_ratio']:.2f}')
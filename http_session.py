@@ -0,0 +1,270 @@
+import openmeteo_requests
+
+import requests_cache
+from requests.adapters import HTTPAdapter
+from retry_requests import retry
+from dadata import Dadata
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, parse_qs
+import time
+
+from metrics import get_metrics
+
+
+LAST_ACCESS_TABLE = 'CREATE TABLE IF NOT EXISTS last_access (key TEXT PRIMARY KEY, accessed REAL)'
+
+# Archive endpoints never change data already published, so their responses are kept forever
+URLS_EXPIRE_AFTER = {
+    'archive-api.open-meteo.com': requests_cache.NEVER_EXPIRE,
+    'air-quality-api.open-meteo.com': requests_cache.NEVER_EXPIRE,
+    'history.openweathermap.org': requests_cache.NEVER_EXPIRE
+}
+
+
+def request_end(url: str, params: dict | None) -> datetime | None:
+    """
+    Return the last requested day: end_date of Open-Meteo params or end timestamp of OpenWeather url
+    """
+
+    params = params or {}
+    query = parse_qs(urlparse(url).query)
+
+    if 'end_date' in params:
+        return datetime.strptime(params['end_date'], '%Y-%m-%d')
+    if 'end' in query:
+        return datetime.fromtimestamp(int(query['end'][0]))
+
+    return None
+
+
+class CountingSession(requests_cache.CachedSession):
+    """
+    Cached session that counts requests and cache hits and remembers when every cache key was used
+    Responses covering the last recent_days days expire after recent_expire_after seconds,
+    because archives still fill and correct recent days
+    """
+
+    def __init__(self, *args, recent_days: int = 7, recent_expire_after: int = 86400, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.recent_days = recent_days
+        self.recent_expire_after = recent_expire_after
+        self.requests = 0
+        self.cache_hits = 0
+        self.accessed = {}
+
+
+    def request(self, method, url, *args, **kwargs):
+        end = request_end(url, kwargs.get('params') or kwargs.get('data'))
+        if end is not None and end >= datetime.now() - timedelta(days=self.recent_days) and 'expire_after' not in kwargs:
+            kwargs['expire_after'] = self.recent_expire_after
+
+        start = time.perf_counter()
+        response = super().request(method, url, *args, **kwargs)
+        elapsed = time.perf_counter() - start
+
+        from_cache = getattr(response, 'from_cache', False)
+        self.requests += 1
+        self.cache_hits += int(from_cache)
+        self.count(urlparse(url).netloc, from_cache, elapsed, response)
+
+        if getattr(response, 'cache_key', None):
+            self.accessed[response.cache_key] = time.time()
+
+        return response
+
+
+    def count(self, host: str, from_cache: bool, elapsed: float, response):
+        """
+        Add request to shared metrics: latency, downloaded bytes and retries made by the adapter
+        """
+
+        metrics = get_metrics()
+        cache = 'hit' if from_cache else 'miss'
+        metrics.inc('http_requests_total', host=host, cache=cache)
+        metrics.observe('http_request_seconds', elapsed, host=host, cache=cache)
+
+        if not from_cache:
+            metrics.inc('http_bytes_downloaded_total', len(response.content), host=host)
+            retries = getattr(getattr(response.raw, 'retries', None), 'history', None)
+            if retries:
+                metrics.inc('http_retries_total', len(retries), host=host)
+
+
+class PooledAdapter(HTTPAdapter):
+    """
+    Http adapter that remembers connection pools it used to report connection reuse
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.used_pools = {}
+
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        pool = super().get_connection_with_tls_context(request, verify, proxies=proxies, cert=cert)
+        self.used_pools[id(pool)] = pool
+        return pool
+
+
+class HttpSession:
+    """
+    One long-lived connection pool and http cache shared by all parsers
+    """
+
+    def __init__(self, cache_name: str = '.cache', backend: str = 'sqlite', expire_after: int = -1,
+                 pool_connections: int = 10, pool_maxsize: int = 10, keep_alive: bool = True,
+                 retries: int = 5, backoff_factor: float = 0.2,
+                 urls_expire_after: dict | None = URLS_EXPIRE_AFTER, recent_days: int = 7, recent_expire_after: int = 86400,
+                 offline: bool = False, dadata_url: str | None = None):
+        self.session = CountingSession(cache_name, backend=backend, expire_after=expire_after, urls_expire_after=urls_expire_after,
+                                       recent_days=recent_days, recent_expire_after=recent_expire_after)
+        # Offline session answers from the cache only, missing responses are 504 errors and nothing is sent
+        self.session.settings.only_if_cached = offline
+        retry(self.session, retries=retries, backoff_factor=backoff_factor)
+
+        # retry() mounts adapters with the default pool size, replace them keeping the retry policy
+        for prefix in ('http://', 'https://'):
+            max_retries = self.session.get_adapter(prefix).max_retries
+            self.session.mount(prefix, PooledAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=max_retries))
+
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+
+        self.openmeteo = openmeteo_requests.Client(session=self.session)
+        self.dadata_clients = {}
+        # Suggestions api base url, Dadata default is used when it is not set
+        self.dadata_url = dadata_url
+
+
+    def get(self, url: str, **kwargs):
+        return self.session.get(url, **kwargs)
+
+
+    def get_dadata(self, token: str) -> Dadata:
+        """
+        Dadata keeps its own httpx connection pool, so one client is kept per token
+        """
+
+        if token not in self.dadata_clients:
+            self.dadata_clients[token] = Dadata(token)
+            if self.dadata_url:
+                self.dadata_clients[token]._suggestions._client.base_url = self.dadata_url
+
+        return self.dadata_clients[token]
+
+
+    @contextmanager
+    def offline(self):
+        """
+        Answer requests from the cache only inside the with block
+        """
+
+        only_if_cached = self.session.settings.only_if_cached
+        self.session.settings.only_if_cached = True
+        try:
+            yield self
+        finally:
+            self.session.settings.only_if_cached = only_if_cached
+
+
+    def save_access(self):
+        """
+        Keep last access time of cache keys in the cache database, it orders eviction
+        """
+
+        if not self.session.accessed or not isinstance(self.session.cache, requests_cache.SQLiteCache):
+            return
+
+        with self.session.cache.responses.connection(commit=True) as connection:
+            connection.execute(LAST_ACCESS_TABLE)
+            connection.executemany('INSERT OR REPLACE INTO last_access (key, accessed) VALUES (?, ?)', list(self.session.accessed.items()))
+        self.session.accessed = {}
+
+
+    def evict(self, max_size_mb: float) -> int:
+        """
+        Delete expired responses, then least recently used ones until the sqlite cache is under max_size_mb
+        Return number of deleted responses
+        """
+
+        cache = self.session.cache
+        if not isinstance(cache, requests_cache.SQLiteCache):
+            raise ValueError('Eviction is supported for sqlite cache only')
+
+        n_responses = len(cache.responses)
+        cache.delete(expired=True)
+        self.save_access()
+
+        responses = cache.responses
+        with responses.connection(commit=True) as connection:
+            connection.execute(LAST_ACCESS_TABLE)
+            rows = connection.execute(
+                f'SELECT r.key, LENGTH(r.value) FROM {responses.table_name} r LEFT JOIN last_access a ON a.key = r.key '
+                'ORDER BY COALESCE(a.accessed, 0)'
+            ).fetchall()
+
+        excess = sum(size for _, size in rows) - max_size_mb * 1024 * 1024
+        keys = []
+        for key, size in rows:
+            if excess <= 0:
+                break
+            keys.append(key)
+            excess -= size
+
+        if keys:
+            cache.delete(*keys)
+            with responses.connection(commit=True) as connection:
+                connection.executemany('DELETE FROM last_access WHERE key = ?', [(key,) for key in keys])
+
+        # Deleted pages are returned to the file system only by vacuum
+        responses.vacuum()
+        return n_responses - len(cache.responses)
+
+
+    def stats(self) -> dict:
+        """
+        Return request, cache hit, connection reuse and cache size counters
+        """
+
+        connections, pool_requests = 0, 0
+        for prefix in ('http://', 'https://'):
+            for pool in self.session.get_adapter(prefix).used_pools.values():
+                connections += pool.num_connections
+                pool_requests += pool.num_requests
+
+        cache = self.session.cache
+        return {
+            'requests': self.session.requests,
+            'cache_hits': self.session.cache_hits,
+            'hit_rate': self.session.cache_hits / self.session.requests if self.session.requests else 0,
+            'connections': connections,
+            'reused_connections': max(pool_requests - connections, 0),
+            'cache_responses': len(cache.responses),
+            'cache_size_mb': cache.responses.size() / 1024 / 1024 if isinstance(cache, requests_cache.SQLiteCache) else None
+        }
+
+
+    def close(self):
+        self.save_access()
+        self.session.close()
+        for client in self.dadata_clients.values():
+            client.close()
+        self.dadata_clients = {}
+
+
+shared_session = None
+
+
+def get_session(**kwargs) -> HttpSession:
+    """
+    Return session shared by all parsers, it is created on the first call
+    """
+
+    global shared_session
+
+    if shared_session is None:
+        shared_session = HttpSession(**kwargs)
+
+    return shared_session
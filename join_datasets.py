@@ -0,0 +1,130 @@
+import pandas as pd
+import numpy as np
+import os
+from datetime import datetime
+
+from merge_csv import MergeCsv
+from storage import CsvStorage
+
+
+CALENDAR_COLUMNS = ['year', 'month', 'day', 'hour']
+CITY_COLUMNS = ['city_id', 'city_name', 'region', 'lat', 'lon']
+
+
+class JoinDatasets(MergeCsv):
+    """
+    Join merged weather and air quality data without loading them into memory
+    Both datasets are streamed partition by partition: one city from csv merged by MergeCsv (sorted by city_id and date)
+    or one city and year from partitioned parquet/arrow dataset
+    Partitions are joined on date only, city columns are added afterwards from cfo.list.json
+    """
+
+    def __init__(self, weather_path: str, air_path: str, file_to_save: str, storage=None, chunk_rows: int = 500000):
+        super().__init__(None, file_to_save, storage)
+        self.weather_path = weather_path
+        self.air_path = air_path
+        self.chunk_rows = chunk_rows
+
+
+    def iter_csv_partitions(self, path: str):
+        """
+        Yield ((city_id, 0), df) for every city of csv sorted by city_id, reading chunk_rows rows at a time
+        """
+
+        rest = None
+        last_city_id = None
+
+        for chunk in pd.read_csv(path, chunksize=self.chunk_rows):
+            if rest is not None:
+                chunk = pd.concat([rest, chunk], ignore_index=True)
+
+            city_ids = chunk['city_id'].to_numpy()
+            starts = np.flatnonzero(np.r_[True, city_ids[1:] != city_ids[:-1]])
+
+            for start, end in zip(starts[:-1], starts[1:]):
+                if last_city_id is not None and city_ids[start] <= last_city_id:
+                    raise ValueError(f'{path} is not sorted by city_id, merge it again with MergeCsv')
+                last_city_id = city_ids[start]
+                yield (int(city_ids[start]), 0), chunk.iloc[start:end]
+
+            # Last city of the chunk may continue in the next chunk
+            rest = chunk.iloc[starts[-1]:]
+
+        if rest is not None and len(rest):
+            yield (int(rest['city_id'].iloc[0]), 0), rest
+
+
+    def iter_dataset_partitions(self, path: str):
+        """
+        Yield ((city_id, year), df) for every partition of city_id/year dataset
+        """
+
+        city_ids = sorted(int(name.split('=')[1]) for name in os.listdir(path) if name.startswith('city_id='))
+
+        for city_id in city_ids:
+            years = sorted(int(name.split('=')[1]) for name in os.listdir(f'{path}/city_id={city_id}') if name.startswith('year='))
+            for year in years:
+                df = self.storage.read(f'{path}/city_id={city_id}/year={year}')
+                df['year'] = year
+                yield (city_id, year), df
+
+
+    def iter_partitions(self, path: str):
+        if isinstance(self.storage, CsvStorage):
+            return self.iter_csv_partitions(path)
+        return self.iter_dataset_partitions(path)
+
+
+    def join_partition(self, weather: pd.DataFrame, air: pd.DataFrame) -> pd.DataFrame:
+        weather = weather.drop(columns=[column for column in CITY_COLUMNS if column in weather.columns])
+        air = air.drop(columns=[column for column in CALENDAR_COLUMNS + CITY_COLUMNS if column in air.columns])
+        return weather.merge(air, on='date', how='inner')
+
+
+    def join(self, batch_rows: int = 1000000):
+        """
+        Inner join of weather and air quality on (city_id, date) written in batches of batch_rows rows
+        Only one partition of every dataset and one batch are kept in memory
+        """
+
+        weather_partitions = self.iter_partitions(self.weather_path)
+        air_partitions = self.iter_partitions(self.air_path)
+        weather_key, weather = next(weather_partitions, (None, None))
+        air_key, air = next(air_partitions, (None, None))
+
+        columns = None
+        frames, rows, n = [], 0, 0
+
+        while weather_key is not None and air_key is not None:
+            if weather_key < air_key:
+                weather_key, weather = next(weather_partitions, (None, None))
+                continue
+            if air_key < weather_key:
+                air_key, air = next(air_partitions, (None, None))
+                continue
+
+            df = self.join_partition(weather, air)
+            if columns is None:
+                air_columns = [column for column in df.columns if column not in weather.columns]
+                columns = [column for column in weather.columns] + [column for column in CITY_COLUMNS if column not in weather.columns] + air_columns
+
+            frames.append((weather_key[0], df))
+            rows += len(df)
+            n += 1
+
+            if rows >= batch_rows:
+                self.save_df(self.enrich_batch(frames)[columns], self.file_to_save)
+                print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: {n} partitions joined, batch rows: {rows}')
+                frames, rows = [], 0
+
+            weather_key, weather = next(weather_partitions, (None, None))
+            air_key, air = next(air_partitions, (None, None))
+
+        if frames:
+            self.save_df(self.enrich_batch(frames)[columns], self.file_to_save)
+            print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: {n} partitions joined, batch rows: {rows}')
+
+
+if __name__ == '__main__':
+    join_datasets = JoinDatasets('weather_data.csv', 'air_data.csv', 'air_weather_data.csv')
+    join_datasets.join()
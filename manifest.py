@@ -0,0 +1,79 @@
+import json
+import os
+import threading
+
+
+class FetchManifest:
+    """
+    Keeps file, first date and last stored hour of every city per dataset in a json file
+    with the api calls the city file was built by, so it can be replayed from the http cache
+    Entries missing from the manifest are restored from the tail of existing city files
+    """
+
+    def __init__(self, filename: str = 'manifest.json'):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.listings = {}
+
+        try:
+            with open(filename) as file:
+                self.data = json.load(file)
+        except Exception:
+            self.data = {}
+
+
+    def get(self, dataset: str, city_id: int) -> dict | None:
+        return self.data.get(dataset, {}).get(str(city_id))
+
+
+    def update(self, dataset: str, city_id: int, filename: str, startdate: str, last_hour: str, request: dict | None = None):
+        """
+        Calls are kept in order: a download starts the list, append and repair calls are added to it,
+        the list is kept when the file is updated without a call
+        """
+
+        with self.lock:
+            entries = self.data.setdefault(dataset, {})
+            entry = {'file': filename, 'startdate': startdate, 'last_hour': last_hour}
+            requests = entries.get(str(city_id), {}).get('requests', [])
+            if request:
+                requests = [request] if request['mode'] == 'download' else requests + [request]
+            if requests:
+                entry['requests'] = requests
+            entries[str(city_id)] = entry
+
+
+    def scan(self, dataset: str, directory: str, city_id: int, storage) -> dict | None:
+        """
+        Find city file named {startdate}_{enddate}_{city_id} with the latest enddate and add it to the manifest
+        Last stored hour is read by the storage the file was written with
+        """
+
+        if not os.path.isdir(directory):
+            return None
+
+        # Directory is listed once and indexed by city id
+        if directory not in self.listings:
+            self.listings[directory] = {}
+            for filename in os.listdir(directory):
+                if filename.endswith(storage.extension) and filename.count('_') == 2:
+                    self.listings[directory].setdefault(filename[:-len(storage.extension)].split('_')[2], []).append(filename)
+
+        files = self.listings[directory].get(str(city_id), [])
+        files = sorted(files, key=lambda filename: filename.split('_')[1])
+        if not files:
+            return None
+
+        filename = f'{directory}/{files[-1]}'
+        last_hour = storage.last_hour(filename)
+        if not last_hour:
+            return None
+
+        self.update(dataset, city_id, filename, files[-1].split('_')[0], last_hour)
+        return self.get(dataset, city_id)
+
+
+    def save(self):
+        with self.lock:
+            with open(self.filename, 'w') as file:
+                json.dump(self.data, file, indent=4)
@@ -1,14 +1,64 @@
 import pandas as pd
+import numpy as np
 import json
 import os
+import re
 import sys
+import time
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+
+from storage import CsvStorage
+from city_index import get_city_index
+from dataset_index import CsvIndex
+from metrics import get_metrics
+
+
+# City files are named {startdate}_{enddate}_{city_id}, other files in the directory are not merged
+CITY_FILE = re.compile(r'[^_]+_[^_]+_\d+')
+
+
+def get_city_id(filename: str, extension: str) -> int:
+    return int(filename[:-len(extension)].split('_')[2])
+
+
+def prepare_city_file(directory: str, storage, filename: str, i: int, n_files: int) -> tuple | None:
+    """
+    Read city file, sort it by date and add calendar columns, dates are parsed once
+    Return (city_id, df) or None when file can not be read
+    Runs in worker processes when merge is parallel, so only the directory and the storage are sent to them
+    """
+
+    try:
+        df = storage.read(f'{directory}/{filename}')
+    except Exception as e:
+        print(e)
+        print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: {i+1}/{n_files}: Error on {filename}')
+        return None
+
+    dates = pd.to_datetime(df['date'], format='ISO8601')
+    order = np.argsort(dates.to_numpy(), kind='stable')
+    df = df.iloc[order].reset_index(drop=True)
+    dates = pd.DatetimeIndex(dates.iloc[order])
+
+    df['year'] = dates.year
+    df['month'] = dates.month
+    df['day'] = dates.day
+    df['hour'] = dates.hour
+
+    return (get_city_id(filename, storage.extension), df)
 
 
 class MergeCsv:
-    def __init__(self, directory, file_to_save):
+    def __init__(self, directory, file_to_save, storage=None):
         self.directory = directory
         self.file_to_save = file_to_save
+        # Storage from storage.py is used to read city files and to write merged data
+        self.storage = storage or CsvStorage()
+        self.metrics = get_metrics()
+        # Sidecar indexes of written csv files by filename
+        self.indexes = {}
 
 
     def open_json(self, filename: str) -> list[dict]:
@@ -23,15 +73,11 @@ class MergeCsv:
 
 
     def get_city_info(self, city_id):
-        city_list = self.open_json('cfo.list.json')
+        """
+        Look up city in cfo.list.json index, json is parsed once and not for every file
+        """
 
-        for city in city_list:
-            if int(city['id']) == city_id:
-                city_name = city['name'] if 'name' in city.keys() else ''
-                region = city['region'] if 'region' in city.keys() else ''
-                lat = city['coord']['lat'] if 'coord' in city.keys() else 1000
-                lon = city['coord']['lon'] if 'coord' in city.keys() else 1000
-                return (city_name, region, lat, lon)
+        return get_city_index('cfo.list.json').get_info(city_id) or ('', '', 1000, 1000)
 
 
     def find_empty_info(self, city_name, region, lat, lon):
@@ -49,44 +95,111 @@ class MergeCsv:
         return fields.strip()
 
 
-    def merge_csv_files(self):
-        for i, filename in enumerate(os.listdir(self.directory)):
-            if filename[-4:] != '.csv':
-                continue
+    def get_city_id(self, filename: str) -> int:
+        return get_city_id(filename, self.storage.extension)
+
+
+    def iter_city_files(self, filenames: list[str], workers: int):
+        """
+        Yield prepared city files in the order of filenames
+        With several workers files are prepared in a process pool, at most 2 files per worker are kept ahead of the writer
+        """
+
+        if workers <= 1:
+            for i, filename in enumerate(filenames):
+                yield prepare_city_file(self.directory, self.storage, filename, i, len(filenames))
+            return
+
+        with ProcessPoolExecutor(workers) as executor:
+            futures = deque()
+            for i, filename in enumerate(filenames):
+                futures.append(executor.submit(prepare_city_file, self.directory, self.storage, filename, i, len(filenames)))
+                if len(futures) >= workers * 2:
+                    yield futures.popleft().result()
+
+            while futures:
+                yield futures.popleft().result()
 
-            try:
-                df = pd.read_csv(f'{self.directory}/{filename}')
-            except Exception as e:
-                print(e)
-                print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: {i+1}/{len(os.listdir(self.directory))}: Error on {filename}')
 
+    def enrich_batch(self, frames: list[tuple]) -> pd.DataFrame:
+        """
+        Concatenate prepared (city_id, df) frames and add city columns in one vectorized pass
+        City name and region are categoricals built from per-city codes
+        """
 
-            city_id = int(filename[:-4].split('_')[2])
-            city_name, region, lat, lon = self.get_city_info(city_id)
+        df = pd.concat([frame for _, frame in frames], ignore_index=True)
+        lengths = [len(frame) for _, frame in frames]
+        city_ids = [city_id for city_id, _ in frames]
+        infos = [self.get_city_info(city_id) for city_id in city_ids]
 
+        df['city_id'] = np.repeat(city_ids, lengths)
+
+        for k, column in enumerate(['city_name', 'region']):
+            codes, categories = pd.factorize(pd.Series([info[k] for info in infos]))
+            df[column] = pd.Categorical.from_codes(np.repeat(codes, lengths), categories)
+
+        df['lat'] = np.repeat([info[2] for info in infos], lengths)
+        df['lon'] = np.repeat([info[3] for info in infos], lengths)
+
+        return df
+
+
+    def merge_csv_files(self, batch_rows: int = 1000000, workers: int = 1):
+        """
+        Merge city files into file_to_save ordered by city_id and date
+        Files are parsed by workers processes, frames are collected until batch_rows rows
+        and written by this process with one bulk write per batch
+        """
+
+        stage_start = time.perf_counter()
+        filenames = [filename for filename in os.listdir(self.directory)
+                     if filename.endswith(self.storage.extension) and CITY_FILE.fullmatch(filename[:-len(self.storage.extension)])]
+        # Output is sorted by city_id and date: files of one city are ordered by their startdate
+        filenames = sorted(filenames, key=lambda filename: (self.get_city_id(filename), filename.split('_')[0]))
+        frames, rows = [], 0
+
+        for i, city_frame in enumerate(self.iter_city_files(filenames, workers)):
+            if city_frame is None:
+                continue
+
+            city_name, region, lat, lon = self.get_city_info(city_frame[0])
             check_fields = self.find_empty_info(city_name, region, lat, lon)
 
             if check_fields:
-                print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: {i+1}/{len(os.listdir(self.directory))} Info "{self.find_empty_info(city_name, region, lat, lon)}" not found for file {filename}')
-
-            df['year'] = pd.DatetimeIndex(df['date']).year
-            df['month'] = pd.DatetimeIndex(df['date']).month
-            df['day'] = pd.DatetimeIndex(df['date']).day
-            df['hour'] = pd.DatetimeIndex(df['date']).hour
-            df['city_id'] = city_id
-            df['city_name'] = city_name
-            df['region'] = region
-            df['lat'] = lat
-            df['lon'] = lon
-            
-            self.save_df(df, self.file_to_save)
-    
+                print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: {i+1}/{len(filenames)} Info "{check_fields}" not found for file {filenames[i]}')
+
+            frames.append(city_frame)
+            rows += len(city_frame[1])
+
+            if rows >= batch_rows:
+                self.save_df(self.enrich_batch(frames), self.file_to_save)
+                print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: {i+1}/{len(filenames)} files merged, batch rows: {rows}')
+                frames, rows = [], 0
+
+        if frames:
+            self.save_df(self.enrich_batch(frames), self.file_to_save)
+            print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: {len(filenames)}/{len(filenames)} files merged, batch rows: {rows}')
+
+        self.metrics.inc('files_merged_total', len(filenames), directory=self.directory)
+        self.metrics.observe('stage_seconds', time.perf_counter() - stage_start, sample=False, stage='merge_csv_files')
+
 
     def save_df(self, df, filename):
-        if not os.path.isfile(filename):
-            df.to_csv(filename, mode='w', header=True)
-        else:
-            df.to_csv(filename, mode='a', header=False)
+        """
+        Write batch to merged data, byte ranges of csv rows are added to its sidecar index, see dataset_index.py
+        """
+
+        # Index is loaded before the write, it is kept only when it matches the csv size
+        if isinstance(self.storage, CsvStorage) and filename not in self.indexes:
+            self.indexes[filename] = CsvIndex(filename)
+
+        with self.metrics.timer('write_seconds', filename=filename):
+            written = self.storage.write_dataset(df, filename)
+        self.metrics.inc('rows_written_total', len(df), dataset=filename)
+
+        if written is not None:
+            self.indexes[filename].add(df, *written)
+            self.indexes[filename].save()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,178 @@
+from contextlib import contextmanager
+import bisect
+import threading
+import json
+import time
+
+
+# Upper bounds in seconds, suitable for http requests and pipeline stages
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+
+class Histogram:
+    """
+    Cumulative histogram in Prometheus format: count of observations not greater than every bucket bound
+    """
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+    def cumulative(self) -> list[tuple]:
+        result, total = [], 0
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics:
+    """
+    Counters and histograms shared by parsers and MergeCsv, exported to Prometheus text or json
+    Counters are exact, histograms keep every sample_every-th observation of a series to cut timing overhead
+    """
+
+    def __init__(self, sample_every: int = 1):
+        self.sample_every = sample_every
+        self.lock = threading.Lock()
+        self.reset()
+
+
+    def __getstate__(self) -> dict:
+        """
+        Objects holding metrics are sent to worker processes, lock is not copied and observations in workers are not collected
+        """
+
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.calls = {}
+
+
+    def key(self, name: str, labels: dict) -> tuple:
+        return (name, tuple(sorted(labels.items())))
+
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+    def sampled(self, key: tuple) -> bool:
+        calls = self.calls.get(key, 0)
+        self.calls[key] = calls + 1
+        return calls % self.sample_every == 0
+
+
+    def observe(self, name: str, value: float, sample: bool = True, **labels):
+        """
+        Add value to histogram, rare observations like stage durations are kept with sample=False
+        """
+
+        key = self.key(name, labels)
+        with self.lock:
+            if sample and not self.sampled(key):
+                return
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """
+        Observe duration of the with block in seconds
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+
+    def format_labels(self, labels: tuple, extra: dict | None = None) -> str:
+        items = list(labels) + list((extra or {}).items())
+        return '{' + ','.join(f'{name}="{value}"' for name, value in items) + '}' if items else ''
+
+
+    def to_prometheus(self) -> str:
+        lines = []
+        with self.lock:
+            name = None
+            for (key_name, labels), value in sorted(self.counters.items()):
+                if key_name != name:
+                    name = key_name
+                    lines.append(f'# TYPE {name} counter')
+                lines.append(f'{name}{self.format_labels(labels)} {value}')
+
+            name = None
+            for (key_name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                if key_name != name:
+                    name = key_name
+                    lines.append(f'# TYPE {name} histogram')
+                for bound, count in histogram.cumulative():
+                    lines.append(f'{name}_bucket{self.format_labels(labels, {'le': bound})} {count}')
+                lines.append(f'{name}_sum{self.format_labels(labels)} {histogram.sum}')
+                lines.append(f'{name}_count{self.format_labels(labels)} {histogram.count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+    def to_json(self) -> dict:
+        with self.lock:
+            return {
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.counters.items())],
+                'histograms': [{'name': name, 'labels': dict(labels), 'count': histogram.count, 'sum': histogram.sum,
+                                'buckets': {str(bound): count for bound, count in histogram.cumulative()}}
+                               for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0])]
+            }
+
+
+    def export(self, filename: str = 'metrics.prom'):
+        """
+        Write metrics to json file when filename ends with .json and to Prometheus text file otherwise
+        """
+
+        with open(filename, 'w') as file:
+            if filename.endswith('.json'):
+                json.dump(self.to_json(), file, indent=4)
+            else:
+                file.write(self.to_prometheus())
+
+
+shared_metrics = None
+
+
+def get_metrics(**kwargs) -> Metrics:
+    """
+    Return metrics shared by all parsers, they are created on the first call
+    """
+
+    global shared_metrics
+
+    if shared_metrics is None:
+        shared_metrics = Metrics(**kwargs)
+
+    return shared_metrics
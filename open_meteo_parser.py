@@ -0,0 +1,470 @@
+import pandas as pd
+
+from datetime import datetime, timedelta
+import time
+import json
+import os.path
+from functools import partial
+
+from http_session import HttpSession, get_session
+from city_index import get_city_index
+from manifest import FetchManifest
+from storage import CsvStorage
+from async_fetch import AsyncFetcher, QuotaScheduler, OPEN_METEO_LIMITS, request_weight, days_between, limit_reason, max_locations
+from metrics import get_metrics
+from grid_index import GridIndex
+from dataset_schema import DatasetSchema
+
+
+class OpenMeteoParser:
+    """
+    Loads hourly data of one Open-Meteo dataset for every city into one file per city in directory
+    Dataset parsers set schema with url and variables (see dataset_schema.py), directory of city files and dataset name of the manifest and metrics
+    """
+
+    schema: DatasetSchema
+    directory: str
+    dataset: str
+    # Seconds waited after the next minute, hour or day starts when api limit is exceeded
+    wait_margin: int = 1
+
+
+    def __init__(self, startdate, enddate, session: HttpSession | None = None, manifest: FetchManifest | None = None, storage=None,
+                 resolution: float | None = None):
+        self.startdate = startdate
+        self.enddate = enddate
+        self.session = session or get_session()
+        self.manifest = manifest or FetchManifest()
+        # CsvStorage, ParquetStorage or ArrowStorage from storage.py
+        self.storage = storage or CsvStorage()
+        self.metrics = get_metrics()
+        # Cities in one cell of resolution degrees grid are requested once, see grid_index.py
+        self.grid = GridIndex(resolution)
+    
+
+    def open_json(self, filename: str) -> list[dict]:
+        try:
+            with open(filename) as file:
+                data = json.load(file)
+        except Exception as e:
+            data = []
+            print(f'JSON file: {filename} is empty\n{e}')
+        
+        return data
+    
+
+    def get_cities(self, lats: list[float], lons: list[float], startdate: str | None = None, enddate: str | None = None) -> list[pd.DataFrame]:
+        """
+        Get hourly data for several locations in one api call, parser dates are used by default
+        Open-Meteo returns one response per location in the same order as requested
+        """
+
+        params = self.schema.params(lats, lons, startdate or self.startdate, enddate or self.enddate)
+        # Open-Meteo API client with cache and retry on error is shared by all parsers
+        responses = self.session.openmeteo.weather_api(self.schema.url, params=params)
+
+        return [self.process_response(response) for response in responses]
+
+
+    def get_city(self, lat: float, lon: float):
+        return self.get_cities([lat], [lon])[0]
+
+
+    def process_response(self, response) -> pd.DataFrame:
+        return self.schema.to_frame(response)
+    
+    
+    def save_to_csv(self, hourly_data, filename):
+        hourly_dataframe = pd.DataFrame(data = hourly_data)
+        hourly_dataframe.to_csv(filename, index=False)
+
+    
+    def wait_for_limit(self, e: Exception):
+        """
+        Sleep until the next minute, hour or day when api limit is exceeded
+        """
+
+        delay = limit_reason(e)
+
+        if delay == 'Minutely':
+            timeout = 60 - datetime.now().second + self.wait_margin
+            print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: Exceeded {delay}, waiting {timeout} seconds')
+            self.metrics.inc('quota_wait_seconds_total', timeout, limit=delay)
+            time.sleep(timeout)
+
+        elif delay == 'Hourly':
+            new_dt = (datetime.now() + timedelta(hours=1))
+            timeout = (datetime(new_dt.year, new_dt.month, new_dt.day, new_dt.hour, 0, 0) - datetime.now()).total_seconds() + self.wait_margin
+            m = int(timeout//60)
+            s = int(timeout - m * 60)
+            print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: Exceeded {delay}, waiting {m} minutes {s} seconds')
+            self.metrics.inc('quota_wait_seconds_total', timeout, limit=delay)
+            time.sleep(timeout)
+
+        elif delay == 'Daily':
+            new_dt = (datetime.now() + timedelta(days=1))
+            timeout = (datetime(new_dt.year, new_dt.month, new_dt.day, 0, 0, 0) - datetime.now()).total_seconds() + self.wait_margin
+            h = int(timeout//3600)
+            m = int((timeout - (h * 3600))//60)
+            s = int(timeout - h * 3600 - m * 60)
+            print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: Exceeded {delay}, waiting {h} hours {m} minutes {s} seconds')
+            self.metrics.inc('quota_wait_seconds_total', timeout, limit=delay)
+            time.sleep(timeout)
+
+        else:
+            print(e)
+
+
+    def fit_batch_size(self, batch_size: int | None, startdate: str, enddate: str, limit: float = OPEN_METEO_LIMITS['Minutely'][0]) -> int:
+        """
+        Grid points per api call: batch_size is capped, so one call fits into limit api calls (the minutely limit), None is the largest fitting number
+        """
+
+        fitting = max_locations(len(self.schema.variables), days_between(startdate, enddate), limit)
+        return min(batch_size, fitting) if batch_size else fitting
+
+
+    def fetch_points(self, batch: list[tuple], startdate: str | None = None, enddate: str | None = None) -> list[pd.DataFrame]:
+        """
+        Request every grid point of (index, city) pairs once and return data frame of the point for every city
+        Unpublished hours at the end are dropped, so they are not recorded as stored and are requested by the next update
+        """
+
+        points = self.grid.group(batch)
+        frames = [self.schema.drop_unpublished(frame) for frame in self.get_cities([lat for lat, _ in points], [lon for _, lon in points], startdate, enddate)]
+        by_city = {city['id']: frame for cities, frame in zip(points.values(), frames) for _, city in cities}
+
+        return [by_city[city['id']] for _, city in batch]
+
+
+    def request(self, batch: list[tuple], city: dict, startdate: str, enddate: str, mode: str) -> dict:
+        """
+        Api call of the chunk as recorded in the manifest: locations, dates, index of the city point and
+        mode of applying it to the city file (download, append or repair), so replay repeats it exactly
+        """
+
+        points = list(self.grid.group(batch))
+        return {'latitude': [lat for lat, _ in points], 'longitude': [lon for _, lon in points], 'startdate': startdate,
+                'enddate': enddate, 'point': points.index(self.grid.point(city)), 'mode': mode}
+
+
+    def merge_range(self, stored: pd.DataFrame, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Replace hours of stored data frame within the range of df by df, stored hours outside of the range are kept
+        Stored columns read back from a file are cast to the schema dtypes of df, so merged file is written in one format
+        """
+
+        dates = pd.to_datetime(stored['date'], format='ISO8601')
+        stored = stored.assign(date=dates).astype(df.dtypes.to_dict())[~dates.between(df['date'].min(), df['date'].max()).to_numpy()]
+        return pd.concat([stored, df], ignore_index=True).drop_duplicates('date', keep='last').sort_values('date', ignore_index=True)
+
+
+    def fetch_batch(self, batch: list[tuple]) -> list[pd.DataFrame]:
+        """
+        Fetch one chunk of (index, city) pairs in a single api call and save file for every city
+        """
+
+        city_frames = self.fetch_points(batch)
+        for (_, city), city_frame in zip(batch, city_frames):
+            filename = f'{self.directory}/{self.startdate}_{self.enddate}_{city['id']}{self.storage.extension}'
+            self.storage.write(city_frame, filename)
+            self.metrics.inc('rows_written_total', len(city_frame), dataset=self.dataset)
+            if len(city_frame):
+                request = self.request(batch, city, self.startdate, self.enddate, 'download')
+                self.manifest.update(self.dataset, city['id'], filename, self.startdate, str(city_frame['date'].iloc[-1]), request)
+
+        return city_frames
+
+
+    def append_batch(self, batch: list[tuple], startdate: str, enddate: str) -> list[int]:
+        """
+        Fetch one chunk of cities from startdate to enddate and append hours after the last stored one to city file
+        City file is renamed to the new enddate, return number of appended rows per city
+        """
+
+        rows = []
+        city_frames = self.fetch_points(batch, startdate, enddate)
+        for (_, city), city_frame in zip(batch, city_frames):
+            entry = self.manifest.get(self.dataset, city['id'])
+            df = city_frame
+
+            if entry and os.path.isfile(entry['file']):
+                df = df[df['date'] > pd.Timestamp(entry['last_hour'])]
+                filename = f'{self.directory}/{entry['startdate']}_{enddate}_{city['id']}{self.storage.extension}'
+                self.storage.append(df, entry['file'], filename)
+                if len(df):
+                    request = self.request(batch, city, startdate, enddate, 'append')
+                    self.manifest.update(self.dataset, city['id'], filename, entry['startdate'], str(df['date'].iloc[-1]), request)
+                else:
+                    self.manifest.update(self.dataset, city['id'], filename, entry['startdate'], entry['last_hour'])
+            else:
+                filename = f'{self.directory}/{startdate}_{enddate}_{city['id']}{self.storage.extension}'
+                self.storage.write(df, filename)
+                if len(df):
+                    request = self.request(batch, city, startdate, enddate, 'download')
+                    self.manifest.update(self.dataset, city['id'], filename, startdate, str(df['date'].iloc[-1]), request)
+
+            rows.append(len(df))
+            self.metrics.inc('rows_written_total', len(df), dataset=self.dataset)
+
+        return rows
+
+
+    def repair_batch(self, batch: list[tuple], entries: dict, startdate: str, enddate: str) -> list[int]:
+        """
+        Fetch one chunk of cities from startdate to enddate and replace these days in city files of work list entries
+        Stored hours outside of the range are kept, return number of fetched rows per city
+        """
+
+        rows = []
+        city_frames = self.fetch_points(batch, startdate, enddate)
+        for (_, city), city_frame in zip(batch, city_frames):
+            filename = entries[city['id']]['file'] or f'{self.directory}/{startdate}_{enddate}_{city['id']}{self.storage.extension}'
+            df = city_frame
+
+            try:
+                stored = self.storage.read(filename) if os.path.isfile(filename) else None
+            except Exception as e:
+                stored = None
+                print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: City: {city['name']} file {filename} can not be read, it is replaced\n{e}')
+
+            # File that could not be read is replaced by the fetched range, so replay starts it over
+            mode = 'download'
+            if stored is not None and len(stored):
+                df = self.merge_range(stored, df)
+                mode = 'repair'
+
+            self.storage.write(df, filename)
+            if len(df):
+                request = self.request(batch, city, startdate, enddate, mode)
+                self.manifest.update(self.dataset, city['id'], filename, os.path.basename(filename).split('_')[0], str(df['date'].iloc[-1]), request)
+            rows.append(len(city_frame))
+            self.metrics.inc('rows_written_total', len(city_frame), dataset=self.dataset)
+
+        return rows
+
+
+    def get(self, batch_size: int | None = 1):
+        """
+        Load hourly data for every city from cfo.list.json and save one file per city
+        Cities are requested in chunks of batch_size grid points per api call, see fit_batch_size
+        Return number of cities left without file after failed attempts
+        """
+
+        stage_start = time.perf_counter()
+        data = get_city_index('cfo.list.json').cities
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        cities = [(i, city) for i, city in enumerate(data) if not os.path.isfile(f'{self.directory}/{self.startdate}_{self.enddate}_{city['id']}{self.storage.extension}')]
+
+        self.grid.print_report(cities, self.schema.name)
+
+        for batch in self.grid.batches(cities, self.fit_batch_size(batch_size, self.startdate, self.enddate)):
+            j = 1
+            while j < 3:
+                try:
+                    city_frames = self.fetch_batch(batch)
+                    break
+                except Exception as e:
+                    city_frames = []
+                    self.metrics.inc('retries_total', dataset=self.dataset)
+                    self.wait_for_limit(e)
+                    j += 1
+
+            for n, (i, city) in enumerate(batch):
+                rows = len(city_frames[n]['date']) if n < len(city_frames) else 0
+                print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: Attempt: {j}/3 {i+1}/{len(data)} City: {city['name']} City_id: {city['id']} rows: {rows}')
+
+        self.manifest.save()
+        self.metrics.observe('stage_seconds', time.perf_counter() - stage_start, sample=False, stage=f'get_{self.dataset}')
+        return len([city for city in data if not os.path.isfile(f'{self.directory}/{self.startdate}_{self.enddate}_{city['id']}{self.storage.extension}')])
+
+
+    def get_async(self, batch_size: int | None = 1, concurrency: int = 8, scheduler: QuotaScheduler | None = None):
+        """
+        Same as get, but keeps up to concurrency api calls in flight
+        Calls are paced by the quota scheduler, so minutely, hourly and daily limits are not exceeded
+        Return number of cities left without file
+        """
+
+        stage_start = time.perf_counter()
+        data = get_city_index('cfo.list.json').cities
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        cities = [(i, city) for i, city in enumerate(data) if not os.path.isfile(f'{self.directory}/{self.startdate}_{self.enddate}_{city['id']}{self.storage.extension}')]
+        scheduler = scheduler or QuotaScheduler()
+        # Chunks are kept light enough for the scheduler to pace them at no less than half of the limits
+        batches = self.grid.batches(cities, self.fit_batch_size(batch_size, self.startdate, self.enddate, scheduler.max_weight()))
+        self.grid.print_report(cities, self.schema.name)
+        n_days = days_between(self.startdate, self.enddate)
+
+        fetcher = AsyncFetcher(scheduler, concurrency)
+        results = fetcher.fetch([(request_weight(len(self.grid.group(batch)), len(self.schema.variables), n_days), partial(self.fetch_batch, batch)) for batch in batches])
+
+        for batch, city_frames in zip(batches, results):
+            for n, (i, city) in enumerate(batch):
+                rows = len(city_frames[n]['date']) if city_frames and n < len(city_frames) else 0
+                print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: {i+1}/{len(data)} City: {city['name']} City_id: {city['id']} rows: {rows}')
+
+        self.manifest.save()
+        self.metrics.observe('stage_seconds', time.perf_counter() - stage_start, sample=False, stage=f'get_{self.dataset}_async')
+        return len([city for city in data if not os.path.isfile(f'{self.directory}/{self.startdate}_{self.enddate}_{city['id']}{self.storage.extension}')])
+
+
+    def replay(self):
+        """
+        Rebuild city files from the http cache only, nothing is sent to the api
+        Calls recorded in the manifest by download, append and repair are repeated in order with the same locations and dates,
+        cache key includes all locations of the call, so calls shared by cities of one chunk are repeated once
+        Files are written under the names in the manifest, manifest is not changed
+        Return number of cities left without rebuilt file
+        """
+
+        stage_start = time.perf_counter()
+        data = get_city_index('cfo.list.json').cities
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        pending = 0
+        # Frames of calls of the previous city, cities of one chunk follow each other
+        frames = {}
+        with self.session.offline():
+            for i, city in enumerate(data):
+                entry = self.manifest.get(self.dataset, city['id'])
+                requests = entry.get('requests', []) if entry else []
+                if not requests or requests[0]['mode'] != 'download':
+                    pending += 1
+                    print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: Replay {i+1}/{len(data)} City: {city['name']} City_id: {city['id']} no recorded download')
+                    continue
+
+                keys = [(tuple(request['latitude']), tuple(request['longitude']), request['startdate'], request['enddate']) for request in requests]
+                frames = {key: frames[key] for key in keys if key in frames}
+
+                df = None
+                try:
+                    for key, request in zip(keys, requests):
+                        if key not in frames:
+                            frames[key] = [self.schema.drop_unpublished(frame) for frame in self.get_cities(list(key[0]), list(key[1]), key[2], key[3])]
+                        city_frame = frames[key][request['point']]
+
+                        if request['mode'] == 'append':
+                            df = pd.concat([df, city_frame[city_frame['date'] > df['date'].iloc[-1]]], ignore_index=True)
+                        elif request['mode'] == 'repair':
+                            df = self.merge_range(df, city_frame)
+                        else:
+                            df = city_frame
+                except Exception as e:
+                    pending += 1
+                    print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: Replay {i+1}/{len(data)} City: {city['name']} City_id: {city['id']} not in cache\n{e}')
+                    continue
+
+                # Hours stored without a recorded call can not be rebuilt, the file is left as it is
+                if str(df['date'].iloc[-1]) != entry['last_hour']:
+                    pending += 1
+                    print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: Replay {i+1}/{len(data)} City: {city['name']} City_id: {city['id']} '
+                          f'recorded calls end at {df['date'].iloc[-1]}, file at {entry['last_hour']}, not replayed')
+                    continue
+
+                self.storage.write(df, entry['file'])
+                print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: Replay {i+1}/{len(data)} City: {city['name']} City_id: {city['id']} rows: {len(df)}')
+
+        self.metrics.observe('stage_seconds', time.perf_counter() - stage_start, sample=False, stage=f'replay_{self.dataset}')
+        return pending
+
+
+    def update(self, enddate: str, batch_size: int | None = 1):
+        """
+        Extend every city file up to enddate requesting only hours after the last stored one
+        Cities are grouped by the first missing day, so they can still be requested in chunks
+        Cities without any file are loaded from the parser startdate
+        Return number of cities of chunks that failed all attempts
+        """
+
+        stage_start = time.perf_counter()
+        data = get_city_index('cfo.list.json').cities
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        groups = {}
+        pending = 0
+        for i, city in enumerate(data):
+            entry = self.manifest.get(self.dataset, city['id'])
+            if not entry or not os.path.isfile(entry['file']):
+                entry = self.manifest.scan(self.dataset, self.directory, city['id'], self.storage)
+            startdate = (pd.Timestamp(entry['last_hour']) + pd.Timedelta(hours=1)).strftime('%Y-%m-%d') if entry else self.startdate
+
+            if startdate <= enddate:
+                groups.setdefault(startdate, []).append((i, city))
+
+        for startdate, cities in groups.items():
+            for batch in self.grid.batches(cities, self.fit_batch_size(batch_size, startdate, enddate)):
+                j = 1
+                while j < 3:
+                    try:
+                        rows = self.append_batch(batch, startdate, enddate)
+                        break
+                    except Exception as e:
+                        rows = []
+                        self.metrics.inc('retries_total', dataset=self.dataset)
+                        self.wait_for_limit(e)
+                        j += 1
+                else:
+                    pending += len(batch)
+
+                for n, (i, city) in enumerate(batch):
+                    print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: Attempt: {j}/3 {i+1}/{len(data)} City: {city['name']} City_id: {city['id']} {startdate}-{enddate} new rows: {rows[n] if n < len(rows) else 0}')
+
+                # Files are renamed on append, so manifest is saved after every chunk
+                self.manifest.save()
+
+        self.metrics.observe('stage_seconds', time.perf_counter() - stage_start, sample=False, stage=f'update_{self.dataset}')
+        return pending
+
+
+    def repair(self, worklist_filename: str = 'refetch.json', batch_size: int | None = 1):
+        """
+        Refetch only broken pieces of city files listed by validator.py
+        Cities with the same range of days are requested in chunks, repaired entries are removed from the work list
+        Return number of entries left in the work list
+        """
+
+        stage_start = time.perf_counter()
+        worklist = self.open_json(worklist_filename)
+        index = get_city_index('cfo.list.json')
+        entries = {entry['city_id']: entry for entry in worklist if entry['dataset'] == self.dataset and entry['city_id'] in index}
+
+        groups = {}
+        for n, entry in enumerate(entries.values()):
+            groups.setdefault((entry['startdate'], entry['enddate']), []).append((n, index.get(entry['city_id'])))
+
+        repaired = set()
+        for (startdate, enddate), cities in groups.items():
+            for batch in self.grid.batches(cities, self.fit_batch_size(batch_size, startdate, enddate)):
+                j = 1
+                while j < 3:
+                    try:
+                        rows = self.repair_batch(batch, entries, startdate, enddate)
+                        repaired.update(city['id'] for _, city in batch)
+                        break
+                    except Exception as e:
+                        rows = []
+                        self.metrics.inc('retries_total', dataset=self.dataset)
+                        self.wait_for_limit(e)
+                        j += 1
+
+                for k, (n, city) in enumerate(batch):
+                    print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: Attempt: {j}/3 {n+1}/{len(entries)} City: {city['name']} City_id: {city['id']} {startdate}-{enddate} repaired rows: {rows[k] if k < len(rows) else 0}')
+
+        self.manifest.save()
+        with open(worklist_filename, 'w') as file:
+            json.dump([entry for entry in worklist if entry['dataset'] != self.dataset or entry['city_id'] not in repaired], file, indent=4)
+
+        print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: {len(repaired)}/{len(entries)} cities repaired')
+        self.metrics.observe('stage_seconds', time.perf_counter() - stage_start, sample=False, stage=f'repair_{self.dataset}')
+        return len(entries) - len(repaired)
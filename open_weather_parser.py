@@ -1,14 +1,54 @@
-import requests
+import pandas as pd
+import numpy as np
+
 import json
 import os.path
+import shutil
 from datetime import datetime
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from http_session import HttpSession, get_session
+from city_index import get_city_index
+from async_fetch import RateLimiter
+from storage import CsvStorage
+from metrics import get_metrics
+
+
+# History API returns at most one week of hourly data per call
+MAX_WINDOW = 7 * 86400
+
+# Flat float32 columns: (path in api record, value when the field is absent), rain and snow are absent when there is no precipitation
+WEATHER_COLUMNS = {
+    'temp': (('main', 'temp'), np.nan),
+    'feels_like': (('main', 'feels_like'), np.nan),
+    'temp_min': (('main', 'temp_min'), np.nan),
+    'temp_max': (('main', 'temp_max'), np.nan),
+    'pressure': (('main', 'pressure'), np.nan),
+    'humidity': (('main', 'humidity'), np.nan),
+    'wind_speed': (('wind', 'speed'), np.nan),
+    'wind_deg': (('wind', 'deg'), np.nan),
+    'wind_gust': (('wind', 'gust'), np.nan),
+    'clouds': (('clouds', 'all'), np.nan),
+    'rain_1h': (('rain', '1h'), 0),
+    'snow_1h': (('snow', '1h'), 0),
+    'weather_id': (('weather', 'id'), np.nan)
+}
 
 
 class OpenWeatherParser:
-    def __init__(self, token: str, timeout: float = 1):
+    url = 'https://history.openweathermap.org/data/2.5/history/city'
+    # City files are named {city_id}_{name}_{start}_{end}, so they are kept apart from Open-Meteo files merged by merge_csv.py
+    directory = 'open_weather_by_city'
+
+
+    def __init__(self, token: str, timeout: float = 1, session: HttpSession | None = None, storage=None):
         self.token = token
         self.timeout = timeout
+        self.session = session or get_session()
+        # Storage from storage.py writes flattened windows and city files
+        self.storage = storage or CsvStorage()
+        self.metrics = get_metrics()
     
     def open_json(self, filename: str) -> list[dict]:
         """
@@ -35,43 +75,129 @@ class OpenWeatherParser:
 
 
     def get_weather(self, city_id: int, start: int, end: int) -> list:
-        url = f'https://history.openweathermap.org/data/2.5/history/city?id={city_id}&start={start}&end={end}&units=metric&type=day&appid={self.token}'
-        weather_list = requests.get(url).json()['list']
+        url = f'{self.url}?id={city_id}&start={start}&end={end}&units=metric&type=hour&appid={self.token}'
+        weather_list = self.session.get(url).json()['list']
         return weather_list
 
     
-    def load_weather_by_city(self, start: int, end: int):
-        city_list = self.open_json('cfo.list.json')
+    def flatten_weather(self, weather: list[dict]) -> pd.DataFrame:
+        """
+        Flatten api records into date and typed WEATHER_COLUMNS columns
+        """
+
+        df = pd.DataFrame({'date': pd.to_datetime(np.fromiter((record['dt'] for record in weather), np.int64, len(weather)), unit='s')})
+
+        for column, ((group, field), default) in WEATHER_COLUMNS.items():
+            if group == 'weather':
+                values = (record['weather'][0].get(field, default) if record.get('weather') else default for record in weather)
+            else:
+                values = (record.get(group, {}).get(field, default) for record in weather)
+            df[column] = np.fromiter(values, np.float32, len(weather))
+
+        return df
+
+
+    def read_weather(self, filename: str, columns: list[str] | None = None) -> pd.DataFrame:
+        """
+        Read city file or window into date and float32 columns, df.to_numpy() gives one float32 array
+        """
+
+        df = self.storage.read(filename, columns=columns)
+        if 'date' in df.columns:
+            df['date'] = pd.to_datetime(df['date'])
+
+        return df.astype({column: np.float32 for column in df.columns if column in WEATHER_COLUMNS})
+
 
-        if not os.path.isdir('weather_by_city'):
-             os.makedirs('weather_by_city')
+    def get_windows(self, start: int, end: int, window: int) -> list[tuple]:
+        """
+        Split [start, end) into (window_start, window_end) pairs, window_end is the last hour of the window
+        """
+
+        return [(startdate, min(startdate + window, end) - 3600) for startdate in range(start, end, window)]
 
+
+    def fetch_window(self, city: dict, startdate: int, enddate: int, parts_directory: str, limiter: RateLimiter) -> int:
+        """
+        Fetch one window of city weather and checkpoint it flattened to parts_directory, return number of rows
+        Checkpoint is written to a temporary file and renamed, so a crash never leaves a truncated window that looks fetched
+        """
+
+        limiter.wait()
+        weather = self.get_weather(city['id'], startdate, enddate)
+        part = f'{parts_directory}/{startdate}_{enddate}{self.storage.extension}'
+        self.storage.write(self.flatten_weather(weather), f'{part}.tmp')
+        os.replace(f'{part}.tmp', part)
+        self.metrics.inc('rows_written_total', len(weather), dataset='open_weather')
+
+        print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: City: {city['name']} {datetime.fromtimestamp(startdate).strftime('%d.%m.%Y %H:%M:%S')}-{datetime.fromtimestamp(enddate).strftime('%d.%m.%Y %H:%M:%S')} rows: {len(weather)}')
+        return len(weather)
+
+
+    def assemble_city(self, filename: str, parts_directory: str, windows: list[tuple]):
+        """
+        Stream checkpointed windows of city into filename one window at a time and remove checkpoints
+        """
+
+        parts = (self.read_weather(f'{parts_directory}/{startdate}_{enddate}{self.storage.extension}') for startdate, enddate in windows)
+        self.storage.write_chunks(parts, filename)
+        shutil.rmtree(parts_directory)
+
+
+    def load_weather_by_city(self, start: int, end: int, workers: int = 1, requests_per_second: float | None = None, window: int = MAX_WINDOW):
+        """
+        Load hourly history of every city from start to end into directory
+        City x window grid is fetched by workers threads, at most requests_per_second calls per second (1 / timeout by default)
+        Every fetched window is checkpointed to {filename}.parts, so a restarted run fetches only missing windows,
+        city file is written when all its windows are fetched
+        """
+
+        stage_start = time.perf_counter()
+        city_list = get_city_index('cfo.list.json').cities
+        windows = self.get_windows(start, end, min(window, MAX_WINDOW))
+
+        if not os.path.isdir(self.directory):
+             os.makedirs(self.directory)
+
+        tasks = []
+        remaining = {}
         for city in city_list:
-            city_weather = []
-            startdate = start
-            enddate = startdate + 82800
-            filename = f'weather_by_city/{city['id']}_{city['name']}_{start}_{end}.json'
-            
+            filename = f'{self.directory}/{city['id']}_{city['name']}_{start}_{end}{self.storage.extension}'
             if os.path.isfile(filename):
                  continue
 
-            while True:
-                if startdate == end:
-                    break
+            parts_directory = f'{filename}.parts'
+            os.makedirs(parts_directory, exist_ok=True)
+            missing = [(startdate, enddate) for startdate, enddate in windows if not os.path.isfile(f'{parts_directory}/{startdate}_{enddate}{self.storage.extension}')]
 
+            remaining[city['id']] = len(missing)
+            if not missing:
+                self.assemble_city(filename, parts_directory, windows)
+            tasks.extend((city, filename, parts_directory, startdate, enddate) for startdate, enddate in missing)
+
+        limiter = RateLimiter(requests_per_second or 1 / self.timeout)
+        failed = 0
+
+        with ThreadPoolExecutor(workers) as executor:
+            futures = {executor.submit(self.fetch_window, city, startdate, enddate, parts_directory, limiter): (city, filename, parts_directory)
+                       for city, filename, parts_directory, startdate, enddate in tasks}
+
+            for future in as_completed(futures):
+                city, filename, parts_directory = futures[future]
                 try:
-                    weather = self.get_weather(city['id'], startdate, enddate)
-                except Exception:
-                     weather = []
-                
-                print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: City: {city['name']} {datetime.fromtimestamp(startdate).strftime('%d.%m.%Y %H:%M:%S')}-{datetime.fromtimestamp(enddate).strftime('%d.%m.%Y %H:%M:%S')} rows: {len(weather)}')
-                city_weather.extend(weather)
-                time.sleep(self.timeout)
+                    future.result()
+                except Exception as e:
+                    failed += 1
+                    self.metrics.inc('windows_failed_total', dataset='open_weather')
+                    print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: City: {city['name']} window failed, it is fetched on the next run\n{e}')
+                    continue
+
+                remaining[city['id']] -= 1
+                if remaining[city['id']] == 0:
+                    self.assemble_city(filename, parts_directory, windows)
 
-                startdate += 86400
-                enddate += 86400
-            self.write_json(f'weather_by_city/{city['id']}_{city['name']}_{start}_{end}.json', city_weather)
-            break
+        print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: {len(tasks) - failed}/{len(tasks)} windows loaded')
+        self.metrics.observe('stage_seconds', time.perf_counter() - stage_start, sample=False, stage='load_weather_by_city')
 
 
 if __name__ == '__main__':
@@ -80,4 +206,5 @@ if __name__ == '__main__':
     token = data[0]['openweathermap_TOKEN']
     
     open_weather_parser = OpenWeatherParser(token, timeout=0.1)
-    open_weather_parser.load_weather_by_city(1704056400, 1730408400)
+    open_weather_parser.load_weather_by_city(1704056400, 1730408400, workers=8, requests_per_second=10)
+    get_metrics().export('metrics.prom')
@@ -0,0 +1,298 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from http_session import get_session
+from manifest import FetchManifest
+from storage import get_storage
+from metrics import get_metrics
+
+
+def file_fingerprint(filename: str, mode: str) -> str:
+    """
+    Size and modification time of the file, or sha256 of its content in hash mode
+    """
+
+    if mode == 'hash':
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as file:
+            for block in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    stat = os.stat(filename)
+    return f'{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def fingerprint(path: str, mode: str = 'mtime') -> str | None:
+    """
+    Fingerprint of a file or of every file in a directory tree, None when path does not exist
+    """
+
+    if os.path.isfile(path):
+        return file_fingerprint(path, mode)
+    if not os.path.isdir(path):
+        return None
+
+    digest = hashlib.sha256()
+    for root, directories, filenames in os.walk(path):
+        directories.sort()
+        for filename in sorted(filenames):
+            filename = os.path.join(root, filename)
+            digest.update(f'{os.path.relpath(filename, path)}={file_fingerprint(filename, mode)}\n'.encode())
+
+    return digest.hexdigest()
+
+
+class Stage:
+    """
+    Pipeline step: run() reads inputs and writes outputs, both are files or directories
+    run() returns number of items it could not process, like cities left after api quota errors, None or 0 when it finished
+    Outputs of a clean stage are removed before it runs, incremental stages like parsers keep them
+    """
+
+    def __init__(self, name: str, run, inputs: list[str], outputs: list[str], params: dict | None = None, clean: bool = False):
+        self.name = name
+        self.run = run
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params = params or {}
+        self.clean = clean
+
+
+class Pipeline:
+    """
+    Runs stages in dependency order, a stage depends on stages producing its inputs
+    Stage is skipped when its inputs and params have the same fingerprint as on the last successful run
+    and its outputs were not changed since, independent stages are run by workers threads
+    """
+
+    def __init__(self, stages: list[Stage], state_filename: str = 'pipeline.state.json', fingerprint_mode: str = 'mtime', workers: int = 2):
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_filename = state_filename
+        self.fingerprint_mode = fingerprint_mode
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.metrics = get_metrics()
+
+        try:
+            with open(state_filename) as file:
+                self.state = json.load(file)
+        except Exception:
+            self.state = {}
+
+
+    def dependencies(self) -> dict[str, set]:
+        producers = {output: stage.name for stage in self.stages.values() for output in stage.outputs}
+        return {stage.name: {producers[path] for path in stage.inputs if path in producers} - {stage.name} for stage in self.stages.values()}
+
+
+    def stage_fingerprint(self, stage: Stage) -> str:
+        inputs = {path: fingerprint(path, self.fingerprint_mode) for path in stage.inputs}
+        return hashlib.sha256(json.dumps({'params': stage.params, 'inputs': inputs}, sort_keys=True, default=str).encode()).hexdigest()
+
+
+    def is_fresh(self, stage: Stage, stage_fingerprint: str) -> bool:
+        state = self.state.get(stage.name)
+        if not state or state['fingerprint'] != stage_fingerprint:
+            return False
+
+        return all(path in state['outputs'] and fingerprint(path, self.fingerprint_mode) == state['outputs'][path] for path in stage.outputs)
+
+
+    def save_state(self):
+        with self.lock:
+            with open(self.state_filename, 'w') as file:
+                json.dump(self.state, file, indent=4)
+
+
+    def run_stage(self, stage: Stage, force: bool = False) -> str:
+        """
+        Run stage unless it is fresh and record fingerprints of its inputs and outputs, return 'done' or 'skipped'
+        State of an incomplete stage is not saved, so it is run again next time
+        """
+
+        stage_fingerprint = self.stage_fingerprint(stage)
+        if not force and self.is_fresh(stage, stage_fingerprint):
+            print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: Stage {stage.name} is up to date, skipped')
+            return 'skipped'
+
+        if stage.clean:
+            for path in stage.outputs:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                elif os.path.isfile(path):
+                    os.remove(path)
+
+        print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: Stage {stage.name} started')
+        start = time.perf_counter()
+        pending = stage.run()
+        seconds = time.perf_counter() - start
+
+        if pending:
+            # State of an earlier run is dropped too, so unchanged inputs and outputs do not make the stage fresh
+            with self.lock:
+                self.state.pop(stage.name, None)
+            self.save_state()
+            print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: Stage {stage.name} is incomplete in {seconds:.1f} s, {pending} pending, state is not saved')
+            return 'incomplete'
+
+        with self.lock:
+            self.state[stage.name] = {
+                'fingerprint': stage_fingerprint,
+                'outputs': {path: fingerprint(path, self.fingerprint_mode) for path in stage.outputs},
+                'finished': datetime.now().isoformat(timespec='seconds'),
+                'seconds': round(seconds, 3)
+            }
+        self.save_state()
+
+        print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: Stage {stage.name} done in {seconds:.1f} s')
+        return 'done'
+
+
+    def run(self, only: list[str] | None = None, force: list[str] | None = None) -> dict[str, str]:
+        """
+        Run only listed stages (all by default), stages listed in force are run even when fresh
+        Return status of every stage: done, skipped, incomplete, failed or blocked by a failed dependency
+        Dependents of an incomplete stage are run on its partial outputs and run again when it is completed
+        """
+
+        names = set(only or self.stages)
+        dependencies = {name: stage_dependencies & names for name, stage_dependencies in self.dependencies().items() if name in names}
+        force = set(force or [])
+        statuses = {}
+        running = {}
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            while len(statuses) < len(names):
+                for name in sorted(names - set(statuses) - set(running.values())):
+                    if any(statuses.get(dependency) in ('failed', 'blocked') for dependency in dependencies[name]):
+                        statuses[name] = 'blocked'
+                        print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: Stage {name} is blocked by a failed dependency')
+                    elif all(dependency in statuses for dependency in dependencies[name]):
+                        running[executor.submit(self.run_stage, self.stages[name], name in force)] = name
+
+                if not running:
+                    if len(statuses) < len(names):
+                        raise ValueError(f'Stages {sorted(names - set(statuses))} have cyclic dependencies')
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        statuses[name] = future.result()
+                    except Exception as e:
+                        statuses[name] = 'failed'
+                        print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: Stage {name} failed\n{e}')
+                    self.metrics.inc('pipeline_stages_total', stage=name, status=statuses[name])
+
+        return statuses
+
+
+def build_stages(config: dict) -> list[Stage]:
+    """
+    Create stages configured in config['stages'], stages missing from config are not run
+    Parsers read cities from cfo.list.json, so it is the output of cfo_cities and input of the fetch stages
+    """
+
+    # Parsers are imported here, so the runner does not need dependencies of stages that are not configured
+    from cfo_cities import DadataParser
+    from open_meteo_weather_parser import WeatherParser
+    from open_meteo_air_quality_parser import AirQualityParser
+    from merge_csv import MergeCsv
+    from join_datasets import JoinDatasets
+    from rollup import Rollup
+
+    stages_config = config['stages']
+    storage = get_storage(config.get('storage', 'csv'))
+    # Manifest is shared, so parallel fetch stages do not overwrite each other's entries
+    manifest = FetchManifest(config.get('manifest_file', 'manifest.json'))
+    stages = []
+
+    if 'cfo_cities' in stages_config:
+        params = stages_config['cfo_cities']
+
+        def run_cfo_cities():
+            with open(config.get('token_file', 'token.json')) as file:
+                token = json.load(file)[0]['dadata_TOKEN']
+            parser = DadataParser(token, timeout=params.get('timeout', 1))
+            return parser.get_cfo_cities(params.get('city_list', 'city.list.json'), 'cfo.list.json', params.get('city_not_found', 'city.not.found.json'),
+                                  workers=params.get('workers', 1), requests_per_second=params.get('requests_per_second', 10))
+
+        stages.append(Stage('cfo_cities', run_cfo_cities, [params.get('city_list', 'city.list.json')], ['cfo.list.json'], params))
+
+    for name, parser_class, directory, method in (('weather', WeatherParser, 'weather_by_city', 'get_weather'),
+                                                  ('air_quality', AirQualityParser, 'air_quality_by_city', 'get_air_quality')):
+        if name not in stages_config:
+            continue
+        params = stages_config[name]
+
+        def run_parser(params=params, parser_class=parser_class, method=method):
+            parser = parser_class(params['startdate'], params['enddate'], manifest=manifest, storage=storage, resolution=params.get('resolution'))
+            return getattr(parser, params.get('method', method))(**params.get('kwargs', {}))
+
+        stages.append(Stage(name, run_parser, ['cfo.list.json'], [directory], params))
+
+    for name, directory in (('merge_weather', 'weather_by_city'), ('merge_air_quality', 'air_quality_by_city')):
+        if name not in stages_config:
+            continue
+        params = stages_config[name]
+
+        def run_merge(params=params, directory=directory):
+            MergeCsv(directory, params['file_to_save'], storage).merge_csv_files(**params.get('kwargs', {}))
+
+        stages.append(Stage(name, run_merge, ['cfo.list.json', directory], [params['file_to_save']], params, clean=True))
+
+    if 'join' in stages_config:
+        params = stages_config['join']
+
+        def run_join():
+            JoinDatasets(params['weather'], params['air_quality'], params['file_to_save'], storage).join(**params.get('kwargs', {}))
+
+        stages.append(Stage('join', run_join, ['cfo.list.json', params['weather'], params['air_quality']], [params['file_to_save']], params, clean=True))
+
+    if 'rollup' in stages_config:
+        params = stages_config['rollup']
+
+        def run_rollup():
+            Rollup(params['path'], params.get('directory', 'rollups'), storage).build()
+
+        # Rollups are rebuilt from the whole joined data, so tables of cities no longer in it are not kept
+        stages.append(Stage('rollup', run_rollup, ['cfo.list.json', params['path']], [params.get('directory', 'rollups')], params, clean=True))
+
+    return stages
+
+
+def load_pipeline(filename: str = 'pipeline.json') -> tuple[Pipeline, dict]:
+    """
+    Create pipeline from json config, see pipeline.json
+    """
+
+    with open(filename) as file:
+        config = json.load(file)
+
+    get_session(**config.get('session', {}))
+    pipeline = Pipeline(build_stages(config), config.get('state_file', 'pipeline.state.json'), config.get('fingerprint', 'mtime'), config.get('workers', 2))
+    return pipeline, config
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run pipeline stages whose inputs changed since the last run')
+    parser.add_argument('config', nargs='?', default='pipeline.json')
+    parser.add_argument('--only', nargs='+', help='stages to run, others are assumed up to date')
+    parser.add_argument('--force', nargs='+', help='stages to run even when they are up to date')
+    args = parser.parse_args()
+
+    pipeline, config = load_pipeline(args.config)
+    statuses = pipeline.run(args.only, args.force)
+    print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: {statuses}')
+
+    get_session().close()
+    get_metrics().export(config.get('metrics_file', 'metrics.prom'))
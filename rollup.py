@@ -0,0 +1,226 @@
+import pandas as pd
+import numpy as np
+import os
+from datetime import datetime
+
+from join_datasets import JoinDatasets, CALENDAR_COLUMNS, CITY_COLUMNS
+from storage import CsvStorage
+
+
+# European AQI band bounds: hours above every bound are counted, 60 and more is poor air quality
+AQI_THRESHOLDS = (40, 60, 80, 100)
+
+# Table every query frequency is answered from and the period dates are floored to
+FREQUENCIES = {
+    'hour': ('hour', None),
+    'day': ('daily', None),
+    'week': ('daily', 'W'),
+    'month': ('monthly', None),
+    'year': ('monthly', 'Y')
+}
+
+STATS = ('mean', 'min', 'max', 'count')
+
+# Stats of european_aqi only: numbers of hours above AQI_THRESHOLDS, summed when rows are combined
+EXCEEDANCE_STATS = tuple(f'hours_over_{threshold}' for threshold in AQI_THRESHOLDS)
+
+
+def to_naive_dates(dates: pd.Series) -> pd.Series:
+    """
+    Parse dates, local hours are stored as UTC by the parsers, so timezone is dropped
+    """
+
+    dates = pd.to_datetime(dates, format='ISO8601')
+    return dates.dt.tz_localize(None) if dates.dt.tz is not None else dates
+
+
+def combine(df: pd.DataFrame, keys: list[str]) -> pd.DataFrame:
+    """
+    Combine rollup rows with equal keys: means are weighted by counts of hours, min, max and counts are combined exactly
+    """
+
+    columns = list(df.columns)
+    variables = [column[:-len('_count')] for column in columns if column.endswith('_count')]
+    sums = pd.DataFrame({f'{variable}_sum': df[f'{variable}_mean'].fillna(0) * df[f'{variable}_count'] for variable in variables}, index=df.index)
+    df = pd.concat([df, sums], axis=1)
+
+    aggregations = {column: 'sum' for column in df.columns if column.endswith(('_sum', '_count')) or column.startswith('european_aqi_hours_over') or column == 'hours'}
+    aggregations.update({column: 'min' for column in df.columns if column.endswith('_min')})
+    aggregations.update({column: 'max' for column in df.columns if column.endswith('_max')})
+
+    result = df.groupby(keys, sort=True, observed=True, dropna=False).agg(aggregations)
+    means = pd.DataFrame({f'{variable}_mean': result[f'{variable}_sum'] / result[f'{variable}_count'].replace(0, np.nan) for variable in variables})
+    result = pd.concat([result, means], axis=1)
+
+    return result[[column for column in columns if column in result.columns and column not in keys]].reset_index()
+
+
+class Rollup(JoinDatasets):
+    """
+    Daily and monthly mean, min, max and number of hours of every variable per city and per region,
+    with hours above AQI_THRESHOLDS of european_aqi, built from merged or joined data
+    Merged data is streamed city by city like in JoinDatasets and every build aggregates all of it again,
+    so hours changed anywhere in the data (repaired gaps, refetched cities) reach the tables,
+    monthly and region tables are combined from daily city rows
+    query() reads the smallest table answering the request
+    """
+
+    def __init__(self, path: str, directory: str = 'rollups', storage=None, chunk_rows: int = 500000):
+        super().__init__(path, None, None, storage, chunk_rows)
+        self.path = path
+        self.directory = directory
+        self.loaded = {}
+
+
+    def table_path(self, table: str) -> str:
+        return f'{self.directory}/{table}{self.storage.extension}'
+
+
+    def read_table(self, table: str) -> pd.DataFrame | None:
+        """
+        Read rollup table once, None when it is not built yet
+        """
+
+        if table not in self.loaded:
+            if not os.path.exists(self.table_path(table)):
+                return None
+            df = self.storage.read(self.table_path(table))
+            df['date'] = to_naive_dates(df['date'])
+            self.loaded[table] = df
+
+        return self.loaded[table]
+
+
+    def aggregate_hours(self, city_id: int, df: pd.DataFrame, dates: pd.Series) -> pd.DataFrame:
+        """
+        Aggregate hourly rows of one city to days
+        """
+
+        variables = [column for column in df.columns if column not in CALENDAR_COLUMNS + CITY_COLUMNS + ['date'] and pd.api.types.is_numeric_dtype(df[column])]
+        days = dates.dt.floor('D').to_numpy()
+        grouped = df[variables].groupby(days, sort=True)
+
+        stats = {stat: getattr(grouped, stat)() for stat in STATS}
+        hours = grouped.size()
+        columns = {'city_id': city_id, 'region': self.get_city_info(city_id)[1], 'date': hours.index}
+        columns.update({f'{variable}_{stat}': stats[stat][variable] for variable in variables for stat in STATS})
+        columns['hours'] = hours
+
+        if 'european_aqi' in variables:
+            for threshold in AQI_THRESHOLDS:
+                columns[f'european_aqi_hours_over_{threshold}'] = (df['european_aqi'] > threshold).groupby(days, sort=True).sum()
+
+        # Frame is created from all columns at once, so it is one block per dtype
+        return pd.DataFrame(columns, index=hours.index).reset_index(drop=True)
+
+
+    def build(self):
+        """
+        Rebuild daily city table from merged data and monthly and region tables from it
+        Merged data is rewritten by every join, so days are not kept from the previous build
+        """
+
+        frames = []
+
+        for i, ((city_id, _), df) in enumerate(self.iter_partitions(self.path)):
+            frames.append(self.aggregate_hours(city_id, df, to_naive_dates(df['date'])))
+            print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: {i+1} partitions aggregated, City_id: {city_id} days: {len(frames[-1])}')
+
+        if not frames:
+            print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: No data in {self.path}, rollups are not built')
+            return
+
+        daily = pd.concat(frames, ignore_index=True)
+        daily = daily.sort_values(['city_id', 'date'], ignore_index=True)
+        monthly = combine(daily.assign(date=daily['date'].dt.to_period('M').dt.start_time), ['city_id', 'region', 'date'])
+
+        tables = {
+            'city_daily': daily,
+            'city_monthly': monthly,
+            'region_daily': combine(daily, ['region', 'date']),
+            'region_monthly': combine(monthly, ['region', 'date'])
+        }
+
+        os.makedirs(self.directory, exist_ok=True)
+        for table, df in tables.items():
+            self.storage.write(df, self.table_path(table))
+        self.loaded = tables
+
+        self.metrics.inc('rows_written_total', len(daily), dataset='rollup')
+        print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: Rollups built, days: {len(daily)}, cities: {daily['city_id'].nunique()}')
+
+
+    def read_hours(self, variables: list[str], city_ids: list[int] | None) -> pd.DataFrame:
+        """
+        Read hourly rows as rollup rows of one hour, used only for hourly queries
+        """
+
+        filters = [('city_id', 'in', list(city_ids))] if city_ids else None
+        df = self.storage.read(self.path, columns=['date', 'city_id', 'region'] + variables, filters=filters)
+
+        hours = pd.DataFrame({'city_id': df['city_id'], 'region': df['region'].astype(str), 'date': to_naive_dates(df['date'])})
+        for variable in variables:
+            hours[f'{variable}_mean'] = df[variable]
+            hours[f'{variable}_min'] = df[variable]
+            hours[f'{variable}_max'] = df[variable]
+            hours[f'{variable}_count'] = df[variable].notna().astype(np.int64)
+            if variable == 'european_aqi':
+                for threshold in AQI_THRESHOLDS:
+                    hours[f'{variable}_hours_over_{threshold}'] = (df[variable] > threshold).astype(np.int64)
+
+        return hours
+
+
+    def query(self, variables: list[str], freq: str = 'day', by: str = 'city', stats: list[str] = ('mean',),
+              city_ids: list[int] | None = None, regions: list[str] | None = None, start: str | None = None, end: str | None = None) -> pd.DataFrame:
+        """
+        Return stats of variables per city or region for every hour, day, week, month or year between start and end dates
+        stats are STATS and EXCEEDANCE_STATS of european_aqi, e.g. stats=['mean', 'hours_over_60']
+        Weeks and years are combined from daily and monthly tables, only hourly queries read merged data
+        """
+
+        unknown = [stat for stat in stats if stat not in STATS + EXCEEDANCE_STATS]
+        if unknown:
+            raise ValueError(f'Unknown stats {unknown}, use {STATS + EXCEEDANCE_STATS}')
+        if any(stat in EXCEEDANCE_STATS for stat in stats) and 'european_aqi' not in variables:
+            raise ValueError(f'{EXCEEDANCE_STATS} are counted only for european_aqi')
+
+        table, period = FREQUENCIES[freq]
+        keys = ['city_id', 'date'] if by == 'city' else ['region', 'date']
+        # Region tables answer region queries unless they are limited to some cities
+        level = 'region' if by == 'region' and not city_ids and table != 'hour' else 'city'
+
+        if table == 'hour':
+            df = self.read_hours(variables, city_ids)
+        else:
+            df = self.read_table(f'{level}_{table}')
+            if df is None:
+                raise ValueError(f'Rollup {level}_{table} is not built, run Rollup.build()')
+
+        mask = pd.Series(True, index=df.index)
+        if city_ids and 'city_id' in df.columns:
+            mask &= df['city_id'].isin(city_ids)
+        if regions:
+            mask &= df['region'].isin(regions)
+        if start:
+            mask &= df['date'] >= pd.Timestamp(start)
+        if end:
+            mask &= df['date'] <= pd.Timestamp(end)
+
+        # Counts are always selected, means of combined rows are weighted by them
+        columns = [f'{variable}_{stat}' for variable in variables for stat in STATS]
+        columns += [f'european_aqi_{stat}' for stat in stats if stat in EXCEEDANCE_STATS]
+        df = df.loc[mask, [column for column in df.columns if column in keys] + columns]
+
+        if period:
+            df = df.assign(date=df['date'].dt.to_period(period).dt.start_time)
+        if period or level != by:
+            df = combine(df, keys)
+
+        return df[keys + [f'{variable}_{stat}' for variable in variables for stat in stats if stat in STATS or variable == 'european_aqi']].reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    rollup = Rollup('air_weather_data.csv', 'rollups', CsvStorage())
+    rollup.build()
+    print(rollup.query(['temperature_2m', 'pm2_5'], freq='month', by='region', stats=['mean', 'max']))
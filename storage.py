@@ -0,0 +1,271 @@
+import pandas as pd
+import numpy as np
+
+import uuid
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+OPERATORS = {
+    '=': lambda column, value: column == value,
+    '==': lambda column, value: column == value,
+    '!=': lambda column, value: column != value,
+    '<': lambda column, value: column < value,
+    '<=': lambda column, value: column <= value,
+    '>': lambda column, value: column > value,
+    '>=': lambda column, value: column >= value,
+    'in': lambda column, value: column.isin(value),
+    'not in': lambda column, value: ~column.isin(value)
+}
+
+
+def apply_filters(df: pd.DataFrame, filters: list | None) -> pd.DataFrame:
+    """
+    Apply filters in pyarrow format: list of (column, operator, value) tuples joined with and,
+    or list of such lists joined with or
+    """
+
+    if not filters:
+        return df
+
+    groups = filters if isinstance(filters[0], list) else [filters]
+    mask = pd.Series(False, index=df.index)
+    for group in groups:
+        group_mask = pd.Series(True, index=df.index)
+        for column, operator, value in group:
+            group_mask &= OPERATORS[operator](df[column], value)
+        mask |= group_mask
+
+    return df[mask]
+
+
+class CsvStorage:
+    """
+    Plain csv files, per-city file keeps the date range in its name and merged data is one appended csv
+    """
+
+    extension = '.csv'
+
+
+    def write(self, df: pd.DataFrame, filename: str):
+        df.to_csv(filename, index=False)
+
+
+    def append(self, df: pd.DataFrame, filename: str, new_filename: str):
+        """
+        Append rows to city file and rename it to the new date range
+        """
+
+        df.to_csv(filename, mode='a', header=False, index=False)
+        os.replace(filename, new_filename)
+
+
+    def last_hour(self, filename: str) -> str:
+        """
+        Return date of the last row without reading the whole file
+        """
+
+        with open(filename, 'rb') as file:
+            file.seek(0, os.SEEK_END)
+            file.seek(max(file.tell() - 4096, 0))
+            last_line = file.read().rstrip(b'\n').split(b'\n')[-1]
+
+        last_hour = last_line.decode().split(',')[0]
+        return '' if last_hour == 'date' else last_hour
+
+
+    def write_chunks(self, chunks, filename: str, chunk_rows: int = 100000):
+        """
+        Write iterable of data frames to one file, only one chunk is kept in memory
+        """
+
+        with open(filename, 'w', newline='') as file:
+            header = True
+            for df in chunks:
+                df.to_csv(file, header=header, index=False)
+                header = False
+
+
+    def write_dataset(self, df: pd.DataFrame, filename: str, chunk_rows: int = 100000) -> tuple:
+        """
+        Append rows to csv, header is written to a new file
+        Rows are rendered chunk_rows at a time, return byte offset where rows start and offsets where every row ends,
+        they are kept in CsvIndex
+        """
+
+        header = not os.path.isfile(filename)
+        ends = []
+
+        with open(filename, 'ab') as file:
+            start = file.tell()
+            for k in range(0, max(len(df), 1), chunk_rows):
+                data = df.iloc[k:k + chunk_rows].to_csv(header=header, index=False).encode()
+                offset = file.tell()
+                file.write(data)
+                ends.append(np.flatnonzero(np.frombuffer(data, np.uint8) == ord('\n')) + offset + 1)
+                header = False
+
+        ends = np.concatenate(ends)
+        if len(ends) > len(df):
+            start, ends = int(ends[0]), ends[1:]
+
+        return start, ends
+
+
+    def read(self, path: str, columns: list[str] | None = None, filters: list | None = None) -> pd.DataFrame:
+        """
+        Read csv file or all csv files of the directory, filters are applied after loading
+        """
+
+        filenames = [os.path.join(path, filename) for filename in sorted(os.listdir(path)) if filename.endswith(self.extension)] if os.path.isdir(path) else [path]
+        filter_columns = [f[0] for group in (filters or []) for f in (group if isinstance(group, list) else [group])]
+        usecols = list(dict.fromkeys(columns + filter_columns)) if columns else None
+
+        df = pd.concat([pd.read_csv(filename, usecols=usecols) for filename in filenames], ignore_index=True)
+        df = apply_filters(df, filters)
+
+        return df[columns] if columns else df
+
+
+class ParquetStorage:
+    """
+    Compressed parquet files keeping float32 and timestamp dtypes
+    City file has one row group per year, so row filters on date skip whole years,
+    merged data is a dataset partitioned by city_id and year
+    """
+
+    extension = '.parquet'
+    format = 'parquet'
+
+
+    def __init__(self, compression: str = 'zstd'):
+        if pa is None:
+            raise ImportError(f'pyarrow is required for {self.__class__.__name__}')
+
+        self.compression = compression
+
+
+    def to_table(self, df: pd.DataFrame):
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+
+    def open_writer(self, filename: str, schema):
+        return pq.ParquetWriter(filename, schema, compression=self.compression)
+
+
+    def write_table(self, table, filename: str, years):
+        with self.open_writer(filename, table.schema) as writer:
+            for year in sorted(set(years)):
+                writer.write_table(table.filter(pa.array(years == year)))
+
+
+    def write_chunks(self, chunks, filename: str, chunk_rows: int = 100000):
+        """
+        Write iterable of data frames with the same columns to one file, chunks are buffered up to chunk_rows rows per row group
+        """
+
+        writer, buffer, rows = None, [], 0
+
+        try:
+            for df in chunks:
+                buffer.append(self.to_table(df))
+                rows += len(df)
+
+                if rows >= chunk_rows:
+                    table = pa.concat_tables(buffer)
+                    writer = writer or self.open_writer(filename, table.schema)
+                    writer.write_table(table)
+                    buffer, rows = [], 0
+
+            if buffer:
+                table = pa.concat_tables(buffer)
+                writer = writer or self.open_writer(filename, table.schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+
+
+    def write(self, df: pd.DataFrame, filename: str):
+        self.write_table(self.to_table(df), filename, pd.DatetimeIndex(df['date']).year.to_numpy())
+
+
+    def append(self, df: pd.DataFrame, filename: str, new_filename: str):
+        """
+        Columnar files can not be appended in place, so city file is rewritten under the new date range
+        """
+
+        df = pd.concat([self.read(filename), df], ignore_index=True)
+        self.write(df, new_filename)
+        if new_filename != filename:
+            os.remove(filename)
+
+
+    def last_hour(self, filename: str) -> str:
+        dates = self.read(filename, columns=['date'])['date']
+        return str(dates.max()) if len(dates) else ''
+
+
+    def write_dataset(self, df: pd.DataFrame, directory: str):
+        """
+        Add rows to the dataset partitioned by city_id and year, every call writes new files
+        """
+
+        ds.write_dataset(
+            self.to_table(df),
+            directory,
+            format=self.format,
+            partitioning=['city_id', 'year'],
+            partitioning_flavor='hive',
+            basename_template=f'part-{uuid.uuid4().hex}-{{i}}{self.extension}',
+            existing_data_behavior='overwrite_or_ignore',
+            file_options=self.file_options()
+        )
+
+
+    def file_options(self):
+        return ds.ParquetFileFormat().make_write_options(compression=self.compression)
+
+
+    def read(self, path: str, columns: list[str] | None = None, filters: list | None = None) -> pd.DataFrame:
+        """
+        Read city file or partitioned dataset, columns and filters are pushed down to the scan
+        """
+
+        dataset = ds.dataset(path, format=self.format, partitioning='hive')
+        expression = pq.filters_to_expression(filters) if filters else None
+        return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+
+class ArrowStorage(ParquetStorage):
+    """
+    Compressed Arrow IPC (feather v2) files with the same layout as ParquetStorage, faster to load than parquet
+    """
+
+    extension = '.arrow'
+    format = 'ipc'
+
+
+    def __init__(self, compression: str = 'lz4'):
+        super().__init__(compression)
+
+
+    def open_writer(self, filename: str, schema):
+        return pa.ipc.new_file(filename, schema, options=pa.ipc.IpcWriteOptions(compression=self.compression))
+
+
+    def file_options(self):
+        return ds.IpcFileFormat().make_write_options(compression=self.compression)
+
+
+STORAGES = {'csv': CsvStorage, 'parquet': ParquetStorage, 'arrow': ArrowStorage}
+
+
+def get_storage(name: str = 'csv', **kwargs):
+    return STORAGES[name](**kwargs)
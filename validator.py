@@ -0,0 +1,150 @@
+import pandas as pd
+import numpy as np
+
+import json
+import os
+import time
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from storage import CsvStorage
+from city_index import get_city_index
+from manifest import FetchManifest
+from merge_csv import CITY_FILE
+from metrics import get_metrics
+
+
+class CityFileValidator:
+    """
+    Checks city files {startdate}_{enddate}_{city_id} of one dataset written by the Open-Meteo parsers:
+    file can be read, every hour from startdate 00:00 to enddate 23:00 is stored once and no variable is NaN for all hours
+    Files end at the last published hour (see DatasetSchema.drop_unpublished), so a file in the manifest is expected to end at its last_hour
+    Broken pieces are written to a refetch work list, repair_weather and repair_air_quality fetch only them
+    """
+
+    def __init__(self, directory: str, dataset: str, storage=None, workers: int = 1):
+        self.directory = directory
+        self.dataset = dataset
+        self.storage = storage or CsvStorage()
+        self.workers = workers
+        self.metrics = get_metrics()
+
+
+    def latest_files(self) -> dict[int, str]:
+        """
+        Return file with the latest enddate of every city, older files are left by updates
+        """
+
+        names = [filename[:-len(self.storage.extension)] for filename in os.listdir(self.directory) if filename.endswith(self.storage.extension)]
+        files = {}
+        for name in sorted((name for name in names if CITY_FILE.fullmatch(name)), key=lambda name: name.split('_')[1]):
+            files[int(name.split('_')[2])] = f'{name}{self.storage.extension}'
+
+        return files
+
+
+    def entry(self, city_id: int, filename: str | None, startdate: str, enddate: str, reasons: dict) -> dict:
+        return {'dataset': self.dataset, 'city_id': city_id, 'file': filename, 'startdate': startdate, 'enddate': enddate, 'reasons': reasons}
+
+
+    def check_file(self, filename: str, last_hour: str | None = None) -> dict | None:
+        """
+        Return work list entry with days to refetch and found problems, None when the file is complete
+        Hours after last_hour are not published yet and are not expected in the file
+        Runs in worker processes when validation is parallel
+        """
+
+        startdate, enddate, city_id = filename[:-len(self.storage.extension)].split('_')
+        path = f'{self.directory}/{filename}'
+
+        try:
+            df = self.storage.read(path)
+            dates = pd.to_datetime(df['date'], format='ISO8601')
+        except Exception as e:
+            return self.entry(int(city_id), path, startdate, enddate, {'unreadable': str(e)})
+
+        # Local hours are stored as UTC, so hours are counted on naive dates
+        dates = dates.dt.tz_localize(None) if dates.dt.tz is not None else dates
+        hours = dates.to_numpy().astype('datetime64[h]').astype(np.int64)
+        first = np.datetime64(startdate, 'h').astype(np.int64)
+        last = np.datetime64(enddate, 'h').astype(np.int64) + 23
+        if last_hour:
+            last = min(last, np.datetime64(pd.Timestamp(last_hour).tz_localize(None), 'h').astype(np.int64))
+
+        unique_hours, counts = np.unique(hours, return_counts=True)
+        inside = unique_hours[(unique_hours >= first) & (unique_hours <= last)]
+        missing = np.ones(last - first + 1, dtype=bool)
+        missing[inside - first] = False
+        duplicated = unique_hours[counts > 1]
+        values = df.drop(columns='date')
+        nan_columns = values.columns[values.isna().all().to_numpy()].tolist() if len(df) else []
+
+        reasons = {}
+        if missing.any():
+            reasons['missing_hours'] = int(missing.sum())
+            if missing[0] or missing[-1]:
+                reasons['truncated'] = True
+        if len(duplicated):
+            reasons['duplicated_hours'] = int(len(duplicated))
+        if nan_columns:
+            reasons['nan_columns'] = nan_columns
+
+        if not reasons:
+            return None
+
+        # One range of days per city keeps the work list compact, all-NaN columns are fetched for the whole file
+        if nan_columns:
+            problem_hours = np.array([first, last])
+        else:
+            problem_hours = np.concatenate([np.flatnonzero(missing) + first, duplicated])
+        days = problem_hours.astype('datetime64[h]').astype('datetime64[D]')
+
+        return self.entry(int(city_id), path, str(days.min()), str(days.max()), reasons)
+
+
+    def validate(self, cities_filename: str = 'cfo.list.json', startdate: str | None = None, enddate: str | None = None,
+                 manifest: FetchManifest | None = None) -> list[dict]:
+        """
+        Check latest file of every city in workers processes and return work list
+        Cities of cities_filename without any file are added from startdate to enddate when they are given
+        Files recorded in the manifest are expected to end at their last_hour, other files at enddate 23:00 of their name
+        """
+
+        stage_start = time.perf_counter()
+        files = self.latest_files() if os.path.isdir(self.directory) else {}
+        entries = {city_id: manifest.get(self.dataset, city_id) if manifest else None for city_id in files}
+        last_hours = [entries[city_id]['last_hour'] if entries[city_id] and entries[city_id]['file'] == f'{self.directory}/{filename}' else None
+                      for city_id, filename in files.items()]
+
+        if self.workers > 1:
+            with ProcessPoolExecutor(self.workers) as executor:
+                results = list(executor.map(self.check_file, files.values(), last_hours, chunksize=16))
+        else:
+            results = [self.check_file(filename, last_hour) for filename, last_hour in zip(files.values(), last_hours)]
+
+        worklist = [entry for entry in results if entry is not None]
+
+        if startdate and enddate:
+            for city in get_city_index(cities_filename).cities:
+                if int(city['id']) not in files:
+                    worklist.append(self.entry(int(city['id']), None, startdate, enddate, {'missing_file': True}))
+
+        for entry in worklist:
+            for reason in entry['reasons']:
+                self.metrics.inc('validation_problems_total', dataset=self.dataset, reason=reason)
+
+        print(f'{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}: {self.dataset}: {len(files)} files checked, {len(worklist)} cities to refetch')
+        self.metrics.observe('stage_seconds', time.perf_counter() - stage_start, sample=False, stage=f'validate_{self.dataset}')
+        return worklist
+
+
+def save_worklist(worklist: list[dict], filename: str = 'refetch.json'):
+    with open(filename, 'w') as file:
+        json.dump(worklist, file, indent=4)
+
+
+if __name__ == '__main__':
+    manifest = FetchManifest()
+    worklist = CityFileValidator('weather_by_city', 'weather', workers=os.cpu_count()).validate(startdate='2022-01-01', enddate='2024-11-01', manifest=manifest)
+    worklist += CityFileValidator('air_quality_by_city', 'air_quality', workers=os.cpu_count()).validate(startdate='2020-01-01', enddate='2021-12-31', manifest=manifest)
+    save_worklist(worklist)